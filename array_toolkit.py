@@ -0,0 +1,255 @@
+'''Collection of NumPy based functions to build many sequences at once.
+Note values are integer-encoded, so that whole batches of sequences can
+be generated as 2-D arrays and decoded back into tuples at the end.
+Requires NumPy.'''
+
+import numpy as np
+
+import sequence_toolkit as tools
+
+
+RAMPS = {'emerge': lambda x: x,  # i / length: pauses thin out, the sequence emerges
+         'fade': lambda x: 1 - x}  # 1 - i / length: pauses take over
+
+
+def encode_melody(melody):
+
+    '''Takes a melody and assigns an integer code to each unique note
+    value. Output is a tuple (states, codes), where states is the sorted
+    list of unique note values and codes is an array with the code of
+    each note of the melody.'''
+
+    states = sorted(set(melody))
+    index = {note: code for code, note in enumerate(states)}
+    codes = np.fromiter((index[note] for note in melody), dtype=np.intp,
+                        count=len(melody))
+    return states, codes
+
+
+def decode_sequences(batch, states):
+
+    '''Takes a 2-D array of codes and the states used to encode them.
+    Returns a list of sequences (lists of note values).'''
+
+    return [[states[code] for code in row] for row in batch.tolist()]
+
+
+def create_transition_arrays(codes, n_states):
+
+    '''Array version of create_transition_matrix. Takes an encoded
+    melody and the number of states, returns the transition probabilities
+    as a CSR matrix: a tuple (indptr, indices, probs) where the followers
+    of state i are indices[indptr[i]:indptr[i + 1]], sorted, with their
+    probabilities in probs.'''
+
+    pairs, counts = np.unique(codes[:-1] * n_states + codes[1:],
+                              return_counts=True)
+    rows, indices = np.divmod(pairs, n_states)
+    totals = np.bincount(rows, weights=counts, minlength=n_states)
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows,
+                                                minlength=n_states))))
+    return indptr, indices, counts / totals[rows]
+
+
+def _create_search_keys(indptr, weights):
+
+    '''Component of generate_batch. Turns the weights of a CSR matrix
+    into one sorted array of keys, where the keys of row i are its
+    cumulative probabilities shifted by i (so they fall in (i, i + 1]).
+    Drawing from row i is then a single searchsorted for i + rand.'''
+
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    cumulative = np.cumsum(weights)
+    row_starts = np.concatenate(([0.0], cumulative))[indptr[:-1]]
+    cumulative -= row_starts[rows]
+    totals = np.bincount(rows, weights=weights, minlength=len(indptr) - 1)
+    return rows + cumulative / totals[rows]
+
+
+def _create_no_rep_arrays(indptr, indices):
+
+    '''Component of generate_batch. Builds the CSR matrix used when a
+    state has appeared three times in a row: each state moves to one
+    of its other followers with equal probability.'''
+
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    others = indices != rows
+    no_rep_indptr = np.concatenate(([0], np.cumsum(np.bincount(
+                        rows[others], minlength=len(indptr) - 1))))
+    return no_rep_indptr, indices[others]
+
+
+def _draw(keys, indptr, indices, state, rand):
+
+    '''Component of generate_batch. Takes the search keys of a CSR
+    matrix, one current state and one random value per sequence.
+    Returns the state drawn for each sequence.'''
+
+    position = np.searchsorted(keys, state + rand, side='right')
+    position = np.clip(position, indptr[state], indptr[state + 1] - 1)  # guards against rounding
+    return indices[position]
+
+
+def generate_batch(codes, n_states, length, count, rng=None):
+
+    '''Array version of generate_sequence. Takes an encoded melody,
+    the number of states, a length (in notes) and a number of sequences.
+    Generates all the sequences at the same time, following the
+    transition probabilities of the melody and avoiding states that
+    have been selected three times in a row. Output is a
+    (count, length) array of codes.'''
+
+    rng = np.random.default_rng(rng)
+    indptr, indices, probs = create_transition_arrays(codes, n_states)
+    keys = _create_search_keys(indptr, probs)
+    no_rep_indptr, no_rep_indices = _create_no_rep_arrays(indptr, indices)
+    no_rep_keys = _create_search_keys(no_rep_indptr,
+                                      np.ones(len(no_rep_indices)))
+    followers = np.diff(indptr)
+    can_break = np.diff(no_rep_indptr) > 0
+    fallback = np.where(followers > 0, np.arange(n_states),
+                        followers.argmax())  # fix for states with no followers
+    limit_rep = n_states > 1  # single states are left on repeat
+    batch = np.empty((count, length), dtype=np.intp)
+    state = rng.choice(codes, size=count)
+    repetitions = np.zeros(count, dtype=np.intp)
+    for i in range(length):
+        state = fallback[state]
+        rand = rng.random(count)
+        new_state = _draw(keys, indptr, indices, state, rand)
+        if limit_rep:
+            breaking = np.flatnonzero((repetitions == 2) & can_break[state])
+            if len(breaking):
+                new_state[breaking] = _draw(no_rep_keys, no_rep_indptr,
+                                            no_rep_indices, state[breaking],
+                                            rand[breaking])
+        repetitions = np.where(new_state == state, repetitions + 1, 0)
+        state = new_state
+        batch[:, i] = state
+    return batch
+
+
+def generate_sequences(melody, length, count, seed=None):
+
+    '''Builds *count* independent note sequences based on the transition
+    probabilities of a melody, in one batch. Takes a melody, a length (in
+    notes), a number of sequences and an optional seed. Output is a list
+    of sequences (lists of note values).'''
+
+    states, codes = encode_melody(melody)
+    batch = generate_batch(codes, len(states), length, count, seed)
+    return decode_sequences(batch, states)
+
+
+def ramp_probabilities(length, ramp='emerge'):
+
+    '''Returns the probability of each of *length* positions of a
+    sequence being kept (sparse sequences) or switched to the next
+    section (transitions). ramp is 'emerge' (i / length, as in
+    create_sparseseq and generate_transition), 'fade' (1 - i / length,
+    as with fading == True), a function taking the array of positions
+    i / length and returning an array of probabilities (e.g. np.sqrt),
+    or an array of *length* probabilities.'''
+
+    if isinstance(ramp, str):
+        if ramp not in RAMPS:
+            raise ValueError('Unknown ramp {!r}. Must be emerge, fade, a '
+                             'function or an array.'.format(ramp))
+        ramp = RAMPS[ramp]
+    if callable(ramp):
+        ramp = ramp(np.arange(length) / float(length))
+    return np.broadcast_to(np.asarray(ramp, dtype=float), (length,))
+
+
+def draw_mask(length, ramp='emerge', count=None, rng=None):
+
+    '''Draws the whole mask of a sequence at once: position i is True
+    with the probability given by the ramp (see ramp_probabilities).
+    Output is a boolean array of shape (length,), or (count, length)
+    for a batch of *count* sequences.'''
+
+    rng = np.random.default_rng(rng)
+    shape = (length,) if count is None else (count, length)
+    return rng.random(shape) < ramp_probabilities(length, ramp)
+
+
+def apply_sparse_mask(codes, mask, pause_code):
+
+    '''Array version of the loop of iter_sparseseq. Takes an array of
+    codes and a mask of the same shape (see draw_mask). Kept positions
+    receive the codes in order, as if each was drawn from a note
+    generator only when needed (the k-th kept position gets the k-th
+    code of its row), and the others receive pause_code. Output is an
+    array of codes, shaped like the mask.'''
+
+    ranks = np.cumsum(mask, axis=-1) - 1
+    notes = np.take_along_axis(codes, np.maximum(ranks, 0), axis=-1)
+    return np.where(mask, notes, pause_code)
+
+
+def apply_transition_mask(codes, mask, n_states):
+
+    '''Array version of the loop of generate_transition. Takes an
+    array of codes and a mask of the same shape (see draw_mask). The
+    codes of switched positions are shifted by n_states, so that the
+    output decodes with the states translated into the section followed
+    by the states translated into the next section (see
+    translate_states).'''
+
+    return np.where(mask, codes + n_states, codes)
+
+
+def translate_states(states, mapping, section, tables=None):
+
+    '''Translates the note values of section A in states into a
+    section (see translate_note), with the optional translation tables
+    of the mapping. Output is a list of note values.'''
+
+    table = tools.get_translation_table(mapping, section, tables)
+    return [tools.translate_note(note, table) for note in states]
+
+
+def generate_sparse_batch(codes, n_states, length, count, ramp='emerge',
+                          rng=None):
+
+    '''Array version of create_sparseseq. Draws the masks of *count*
+    sparse sequences, then generates only as many notes as the fullest
+    sequence keeps (see generate_batch). Output is a (count, length)
+    array of codes, where n_states stands for a pause.'''
+
+    rng = np.random.default_rng(rng)
+    mask = draw_mask(length, ramp, count, rng)
+    kept = int(mask.sum(axis=1).max()) if count and length else 0
+    notes = generate_batch(codes, n_states, max(kept, 1), count, rng)
+    return apply_sparse_mask(notes, mask, n_states)
+
+
+def generate_sparse_sequences(melody, length, count, ramp='emerge',
+                              seed=None):
+
+    '''Builds *count* independent sparse sequences from a melody, in one
+    batch (see generate_sparse_batch). Output is a list of sequences
+    (lists of note values).'''
+
+    states, codes = encode_melody(melody)
+    batch = generate_sparse_batch(codes, len(states), length, count, ramp,
+                                  seed)
+    return decode_sequences(batch, states + [(5,)])
+
+
+def create_transition(sequence, mapping, section, next_section, ramp='emerge',
+                      rng=None, tables=None):
+
+    '''Array version of generate_transition. Takes a sequence of note
+    values of section A (e.g. a list from generate_sequence), a mapping
+    dictionary, the two sections and the same options as draw_mask,
+    plus the optional translation tables of the mapping. Output is the
+    transition as a list of note values.'''
+
+    states, codes = encode_melody(sequence)
+    mask = draw_mask(len(codes), ramp, rng=rng)
+    batch = apply_transition_mask(codes, mask, len(states))
+    return decode_sequences(batch[np.newaxis],
+                            translate_states(states, mapping, section, tables) +
+                            translate_states(states, mapping, next_section,
+                                             tables))[0]
@@ -0,0 +1,196 @@
+'''Non-interactive version of main.py, which renders many sequences from a
+manifest of jobs on a pool of processes. The manifest is a JSONL file
+(one JSON object per line) with the following keys:
+- type: sequence type, 1-5 or basic, mapped, sparse, chord, grouped.
+- source: origin midi file. output: output midi file.
+- length (basic, sparse and grouped sequences, in notes or groups).
+- map: Map file (mapped and chord sequences).
+- fading (sparse, default false), increase (chord).
+- grouping: pauses, pitch or segments (grouped, default pauses), and
+  segment_size (segments).
+- seed (optional): makes the output reproducible.
+- id (optional): reported with the job, defaults to its line number.
+A report is written for each job (as a JSON line) as soon as it is done,
+with its status, number of notes, timings and error if any.
+
+Usage: python batch.py MANIFEST [--workers N] [--report FILE]'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from midi_toolkit import read_melody, write_midifile
+from sequences import create_mapseq, create_sparseseq, create_chordseq
+from sequences import create_groupseq
+import sequence_toolkit as tools
+
+
+SEQUENCE_TYPES = {'1': 'basic', '2': 'mapped', '3': 'sparse', '4': 'chord',
+                  '5': 'grouped'}
+REQUIRED_KEYS = {'basic': ('length',), 'mapped': ('map',),
+                 'sparse': ('length',), 'chord': ('map', 'increase'),
+                 'grouped': ('length',)}
+GROUPINGS = ('pauses', 'pitch', 'segments')
+PENDING_PER_WORKER = 2  # jobs queued per worker, bounds memory on large manifests
+
+
+def read_manifest(filename):
+
+    '''Reads and checks every job of a manifest before any is run, so
+    that mistakes are found at once. Raises ValueError (with the line
+    number) for invalid lines. Output is a list of job dictionaries,
+    with their sequence type normalised to its name.'''
+
+    jobs = []
+    with open(filename, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                jobs.append(check_job(job, line_number))
+            except ValueError as error:
+                raise ValueError('{} line {}: {}'.format(filename, line_number,
+                                                         error))
+    return jobs
+
+
+def check_job(job, line_number, required=('source', 'output')):
+
+    '''Component of read_manifest. Checks that a job has the keys its
+    sequence type needs, plus the *required* ones. Output is the job.'''
+
+    if not isinstance(job, dict):
+        raise ValueError('a job must be a JSON object')
+    job_type = str(job.get('type'))
+    job_type = SEQUENCE_TYPES.get(job_type, job_type)
+    if job_type not in REQUIRED_KEYS:
+        raise ValueError('unknown sequence type {!r}'.format(job.get('type')))
+    missing = [key for key in tuple(required) + REQUIRED_KEYS[job_type]
+               if key not in job]
+    grouping = job.get('grouping', 'pauses')
+    if job_type == 'grouped':
+        if grouping not in GROUPINGS:
+            raise ValueError('unknown grouping {!r}'.format(grouping))
+        if grouping == 'segments' and 'segment_size' not in job:
+            missing.append('segment_size')
+    if missing:
+        raise ValueError('missing {} for a {} sequence'.format(
+                         ', '.join(missing), job_type))
+    job = dict(job, type=job_type)
+    job.setdefault('id', line_number)
+    return job
+
+
+def create_sequence(job, melody):
+
+    '''Builds the sequence of a job from a melody. Jobs with a seed get
+    their own random stream. Output is a list of note values.'''
+
+    seed = job.get('seed')
+    rng = random.Random(seed) if seed is not None else random
+    job_type = job['type']
+    if job_type == 'basic':
+        return list(tools.generate_sequence(melody, job['length'], rng))
+    if job_type == 'mapped':
+        return create_mapseq(melody, job['map'], seed, workers=1)
+    if job_type == 'sparse':
+        return create_sparseseq(melody, job['length'],
+                                job.get('fading', False), rng)
+    if job_type == 'chord':
+        return create_chordseq(melody, job['map'], job['increase'], seed,
+                               workers=1)
+    return create_groupseq(melody, job['length'], job.get('grouping', 'pauses'),
+                           job.get('segment_size'), rng)
+
+
+def run_job(job):
+
+    '''Reads the source of a job, builds a sequence for each of its
+    tracks and writes them out. Errors are reported, not raised. Output
+    is a report dictionary: id, status ('ok' or 'error'), output, notes
+    written, seconds spent reading, generating, writing and in total,
+    and error (failed jobs only).'''
+
+    report = {'id': job['id'], 'output': job['output']}
+    start = time.perf_counter()
+    try:
+        tracks = read_melody(job['source'], fast=True)
+        read = time.perf_counter()
+        sequences = [create_sequence(job, melody) for melody in tracks]
+        generated = time.perf_counter()
+        write_midifile(job['output'], sequences, fast=True)
+        written = time.perf_counter()
+    except Exception as error:  # a failed job must not stop the batch
+        report.update(status='error',
+                      error='{}: {}'.format(type(error).__name__, error),
+                      seconds={'total': time.perf_counter() - start})
+        return report
+    report.update(status='ok',
+                  notes=sum(len(sequence) for sequence in sequences),
+                  seconds={'read': read - start, 'generate': generated - read,
+                           'write': written - generated,
+                           'total': written - start})
+    return report
+
+
+def run_batch(jobs, workers=None):
+
+    '''Runs jobs on a pool of *workers* processes (all cores by default,
+    no pool if workers == 1), queueing at most PENDING_PER_WORKER jobs
+    per worker at a time. Output is a generator of job reports, in the
+    order the jobs finish.'''
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(run_job, jobs)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for job in jobs:
+            if len(pending) >= PENDING_PER_WORKER * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(run_job, job))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('manifest', help='JSONL file of jobs.')
+    parser.add_argument('--workers', type=int,
+                        help='Number of processes (default: all cores).')
+    parser.add_argument('--report', default='-',
+                        help='JSONL file of job reports (default: stdout).')
+    args = parser.parse_args(args)
+    try:
+        jobs = read_manifest(args.manifest)
+    except (OSError, ValueError) as error:
+        raise SystemExit(str(error))
+    report_file = sys.stdout if args.report == '-' else open(args.report, 'w')
+    start = time.perf_counter()
+    failed = 0
+    try:
+        for report in run_batch(jobs, args.workers):
+            failed += report['status'] != 'ok'
+            report_file.write(json.dumps(report) + '\n')
+            report_file.flush()
+    finally:
+        if report_file is not sys.stdout:
+            report_file.close()
+    print('{} jobs, {} failed, {:.2f}s.'.format(
+          len(jobs), failed, time.perf_counter() - start), file=sys.stderr)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+'''Benchmarks for the generation and midi I/O hot paths. Every function is
+run on synthetic melodies of increasing length (in notes) and number of
+distinct note values (states), measuring wall time and peak memory.
+Results are written as JSON and compared against a stored baseline:
+any time or memory regression beyond the tolerance fails the run, and
+so does a missing baseline (unless --save-baseline stores one).
+
+Usage: python benchmark.py [--full] [--notes N ...] [--states N ...]
+                           [--output FILE] [--baseline FILE]
+                           [--save-baseline] [--tolerance FRACTION]'''
+
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+import midi_toolkit
+import sequence_toolkit as tools
+from sequences import create_mapseq, create_sparseseq, create_chordseq
+import mapping_toolkit
+from mapping_toolkit import Map
+
+
+DEFAULT_NOTES = [1000, 10000, 100000]
+FULL_NOTES = [1000, 10000, 100000, 1000000, 10000000]
+DEFAULT_STATES = [10, 100, 1000]
+MAX_SECTIONS = 256
+REPEAT_SECONDS = 1.0  # fast benchmarks are repeated (up to 5 runs) within this time
+NOISE_FLOOR = {'seconds': 0.001, 'peak_bytes': 65536}  # smaller changes are ignored
+PAUSE = (5,)
+
+
+def synthetic_melody(notes, states, seed=0):
+
+    '''Builds a melody of the given length (in notes) with the given
+    number of distinct note values, one of which is a pause. Each note
+    value is followed by one of a few fixed others, so the melody has
+    a structure to learn, like a real one.'''
+
+    rng = random.Random(seed)
+    note_values = {PAUSE}
+    while len(note_values) < states:
+        size = rng.choice((1, 1, 2, 3))
+        note_values.add(tuple(sorted(rng.sample(range(21, 109), size))))
+    note_values = sorted(note_values)
+    followers = [rng.sample(note_values, min(8, states)) for _ in note_values]
+    index = {note_value: i for i, note_value in enumerate(note_values)}
+    current = rng.choice(note_values)
+    melody = []
+    for _ in range(notes):
+        melody.append(current)
+        current = rng.choice(followers[index[current]])
+    return melody
+
+
+def synthetic_map(melody, notes, directory, name):
+
+    '''Writes a Map file whose sections (ABACAB...) share the note values
+    of the melody, transposed, and whose total length is *notes*.
+    Returns the file name (name + .json, within directory).'''
+
+    note_set = sorted(set(melody))
+    mapping = {'A': note_set}
+    for shift, letter in ((2, 'B'), (5, 'C')):
+        mapping[letter] = [tuple(min(note + shift, 127) for note in note_value)
+                           for note_value in note_set]
+    sections_count = min(MAX_SECTIONS, max(1, notes // 64))
+    structure = ('ABAC' * sections_count)[:sections_count]
+    section = notes // (2 * len(structure))
+    sections = [section] * len(structure)
+    transitions = [section] * (len(structure) - 1)
+    sections[-1] += notes - sum(sections + transitions)
+    filename = os.path.join(directory, name + '.json')
+    Map(structure, sections, transitions, mapping).write_compiled_map(filename)
+    return filename
+
+
+def clear_caches():
+
+    '''Empties the caches of parsed files, compiled matrices and Maps,
+    so that every run does the whole work, as before they existed.'''
+
+    midi_toolkit.PARSE_CACHE.clear()
+    tools.COMPILED_CACHE.clear()
+    mapping_toolkit.MAP_CACHE.clear()
+
+
+def create_cases(melody, notes, states, directory):
+
+    '''Returns the benchmarks to run on a melody, as a list of
+    (name, function, arguments) tuples. Input files are written
+    to directory.'''
+
+    name = 'benchmark_{}_{}'.format(notes, states)
+    map_file = synthetic_map(melody, notes, directory, name)
+    midi_file = os.path.join(directory, name + '.mid')
+    midi_toolkit.write_midifile(midi_file, [melody], fast=True)
+    output_file = os.path.join(directory, 'output.mid')
+    return [
+        ('create_transition_matrix', tools.create_transition_matrix,
+         (melody,)),
+        ('generate_sequence', lambda m, n: list(tools.generate_sequence(m, n)),
+         (melody, notes)),
+        ('create_mapseq', create_mapseq, (melody, map_file)),
+        ('create_sparseseq', create_sparseseq, (melody, notes)),
+        ('create_chordseq', create_chordseq, (melody, map_file, 2)),
+        ('group_by_pitch', tools.group_by_pitch, (melody,)),
+        ('group_by_pauses', tools.group_by_pauses, (melody,)),
+        ('group_by_segment_size', tools.group_by_segment_size, (melody, 4)),
+        ('read_midifile', midi_toolkit.read_midifile, (midi_file, True)),
+        ('write_midifile', midi_toolkit.write_midifile,
+         (output_file, [melody], False, True)),
+    ]
+
+
+def measure(function, arguments):
+
+    '''Runs a function for its wall time (best of a few runs when
+    it is fast), then once under tracemalloc for its peak memory.
+    Caches are cleared before each run (see clear_caches). Returns a
+    dictionary.'''
+
+    timings = []
+    while len(timings) < 5 and sum(timings) < REPEAT_SECONDS:
+        clear_caches()
+        start = time.perf_counter()
+        function(*arguments)
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+    clear_caches()
+    tracemalloc.start()
+    try:
+        function(*arguments)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': seconds, 'peak_bytes': peak}
+
+
+def run_benchmarks(notes_list, states_list):
+
+    '''Runs every benchmark for every combination of length and number
+    of states. Returns a dictionary of results keyed by
+    "name|notes|states".'''
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for notes in notes_list:
+            for states in states_list:
+                melody = synthetic_melody(notes, states)
+                cases = create_cases(melody, notes, states, directory)
+                for name, function, arguments in cases:
+                    key = '{}|{}|{}'.format(name, notes, states)
+                    results[key] = measure(function, arguments)
+                    print('{:<45} {:>10.4f}s {:>12,} bytes'.format(
+                          key, results[key]['seconds'],
+                          results[key]['peak_bytes']))
+    return results
+
+
+def compare_results(results, baseline, tolerance):
+
+    '''Compares results with a baseline. Returns a list of messages,
+    one for each measure that grew by more than the tolerance (a
+    fraction, e.g. 0.25 for 25%).'''
+
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for measure_name in ('seconds', 'peak_bytes'):
+            old, new = baseline[key][measure_name], result[measure_name]
+            if (new > old * (1 + tolerance) and
+                    new - old > NOISE_FLOOR[measure_name]):
+                regressions.append('{} {}: {:.4g} -> {:.4g} (+{:.0%})'.format(
+                                   key, measure_name, old, new,
+                                   new / old - 1 if old else float('inf')))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--full', action='store_true',
+                        help='Also run 1M and 10M note benchmarks.')
+    parser.add_argument('--notes', type=int, nargs='+',
+                        help='Melody lengths to run (overrides --full).')
+    parser.add_argument('--states', type=int, nargs='+',
+                        default=DEFAULT_STATES,
+                        help='Numbers of distinct note values to run.')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='File where the results are written.')
+    parser.add_argument('--baseline', default='benchmark_baseline.json',
+                        help='Results to compare against.')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed growth before a regression fails.')
+    args = parser.parse_args()
+    notes_list = args.notes or (FULL_NOTES if args.full else DEFAULT_NOTES)
+    results = run_benchmarks(notes_list, args.states)
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print('Baseline saved: {}.'.format(args.baseline))
+        return
+    if not os.path.exists(args.baseline):  # nothing to compare: fail, not pass
+        raise SystemExit('No baseline found ({}). Run with --save-baseline '
+                         'to store one.'.format(args.baseline))
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)['results']
+    regressions = compare_results(results, baseline, args.tolerance)
+    if regressions:
+        print('REGRESSIONS:\n' + '\n'.join(regressions))
+        raise SystemExit(1)
+    print('No regressions against {}.'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''Contains the bounded caches used to avoid repeating expensive work
+(e.g. parsing the same midi file) within a process.'''
+
+import collections
+import os
+
+
+class LRUCache(object):
+
+    '''Bounded dictionary that discards its least recently used entries
+    once it holds more than maxsize of them. Counts hits, misses and
+    evictions. If weigh is given (a function returning the size of a
+    value), maxsize bounds the total size of the values instead, and
+    values larger than maxsize are not kept.'''
+
+    def __init__(self, maxsize=128, weigh=None):
+        self.maxsize = maxsize
+        self.weigh = weigh
+        self.size = 0  # number of entries, or total size of the values
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()  # key -> (value, size)
+
+    def get(self, key, default=None):
+        try:
+            value, _ = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self._data:
+            self.size -= self._data.pop(key)[1]
+        size = self.weigh(value) if self.weigh else 1
+        if size > self.maxsize:  # would evict everything else
+            return
+        self._data[key] = value, size
+        self.size += size
+        while self.size > self.maxsize:
+            self.size -= self._data.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return ('LRUCache(maxsize={}, entries={}, size={}, hits={}, '
+                'misses={}, evictions={})'.format(
+                self.maxsize, len(self._data), self.size, self.hits,
+                self.misses, self.evictions))
+
+
+def file_key(filename):
+
+    '''Identifies the current version of a file. Returns a tuple
+    (absolute path, size, modification time), which changes whenever
+    the file is edited. Raises FileNotFoundError for missing files.'''
+
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_size, stat.st_mtime_ns
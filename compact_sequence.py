@@ -0,0 +1,119 @@
+'''Contains NoteSequence, a compact container for sequences of note values
+(and optionally their delta times), which can be used wherever a list of
+note values is expected.'''
+
+from array import array
+
+
+class NoteSequence(object):
+
+    '''Sequence of note values stored in arrays instead of a list of
+    tuples. pitches (one byte per note) holds the notes of every chord
+    one after the other, chord i being pitches[offsets[i]:offsets[i + 1]],
+    and durations (optional) holds one delta time per chord. offsets and
+    durations take 4 bytes per chord. Indexing and iterating
+    yield note value tuples. Slices with step 1 are views sharing the
+    arrays of the original sequence; views cannot be extended.'''
+
+    __slots__ = ('pitches', 'offsets', 'durations', 'start', 'stop')
+
+    def __init__(self, note_values=(), durations=None):
+        self.pitches = array('B')
+        self.offsets = array('I', [0])
+        self.durations = None if durations is None else array('I')
+        self.start = 0
+        self.stop = None  # None: the sequence owns its arrays, up to their end
+        if durations is None:
+            self.extend(note_values)
+        else:
+            for note_value, duration in zip(note_values, durations):
+                self.append(note_value, duration)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+
+        '''Builds a timed NoteSequence from (note value, delta time)
+        pairs, e.g. the output of NoteTable.iter_chords or
+        extract_delta_times. Delta times may be 1-tuples.'''
+
+        sequence = cls(durations=())
+        for note_value, duration in pairs:
+            if isinstance(duration, tuple):
+                duration = duration[0]
+            sequence.append(note_value, duration)
+        return sequence
+
+    def append(self, note_value, duration=None):
+        if self.stop is not None:
+            raise ValueError('Cannot extend a view of a NoteSequence.')
+        self.pitches.extend(note_value)
+        self.offsets.append(len(self.pitches))
+        if self.durations is not None:
+            self.durations.append(duration)
+
+    def extend(self, note_values):
+        for note_value in note_values:
+            self.append(note_value)
+
+    def timed(self):
+
+        '''Yields (note value, delta time) pairs. Requires durations.'''
+
+        start, stop = self._bounds()
+        return zip(self, self.durations[start:stop])
+
+    def _bounds(self):
+        stop = len(self.offsets) - 1 if self.stop is None else self.stop
+        return self.start, stop
+
+    def _view(self, start, stop):
+        view = NoteSequence.__new__(NoteSequence)
+        view.pitches = self.pitches
+        view.offsets = self.offsets
+        view.durations = self.durations
+        view.start = start
+        view.stop = stop
+        return view
+
+    def __len__(self):
+        start, stop = self._bounds()
+        return stop - start
+
+    def __getitem__(self, index):
+        start, stop = self._bounds()
+        if isinstance(index, slice):
+            first, last, step = index.indices(stop - start)
+            if step == 1:
+                return self._view(start + first, start + max(first, last))
+            positions = range(start + first, start + last, step)
+            durations = (None if self.durations is None else
+                         [self.durations[i] for i in positions])
+            return NoteSequence((self[i - start] for i in positions), durations)
+        if index < 0:
+            index += stop - start
+        if not 0 <= index < stop - start:
+            raise IndexError('NoteSequence index out of range')
+        offsets = self.offsets
+        index += start
+        return tuple(self.pitches[offsets[index]:offsets[index + 1]])
+
+    def __iter__(self):
+        start, stop = self._bounds()
+        pitches, offsets = self.pitches, self.offsets
+        for i in range(start, stop):
+            yield tuple(pitches[offsets[i]:offsets[i + 1]])
+
+    def __eq__(self, other):
+        if not isinstance(other, (NoteSequence, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(
+                note_value == other_value
+                for note_value, other_value in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        note_values = list(self[:8])
+        return 'NoteSequence({}{})'.format(note_values,
+                                           ' + {} more'.format(len(self) - 8)
+                                           if len(self) > 8 else '')
@@ -0,0 +1,123 @@
+'''Contains functions to train a transition matrix on a whole corpus of
+midi files instead of a single melody. Files are read on a pool of
+processes, each counting the note pairs of its files (map), and the
+counts are then added together into one matrix (reduce), which can be
+passed to generate_from_matrix.
+
+Usage: python corpus_toolkit.py DIRECTORY OUTPUT_FILE [--length N]
+                                [--workers N] [--seed SEED]'''
+
+import os
+import random
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+from midi_toolkit import read_melody, write_midifile
+import sequence_toolkit as tools
+
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+FILES_PER_CHUNK = 64  # files counted by a worker before sending back its counts
+
+
+def find_midi_files(directory):
+
+    '''Lists the midi files within a directory and its subdirectories,
+    sorted by name.'''
+
+    filenames = []
+    for root, _, files in os.walk(directory):
+        filenames.extend(os.path.join(root, name) for name in files
+                         if name.lower().endswith(MIDI_EXTENSIONS))
+    return sorted(filenames)
+
+
+def count_file_transitions(filenames):
+
+    '''Component of count_corpus. Takes a list of midi files and adds up
+    the note pair counts of their melodies. Files that cannot be read
+    are skipped. Output is a tuple (pair counter, notes, files skipped),
+    where notes lists the note values seen, in order of appearance.'''
+
+    pair_counter = collections.Counter()
+    notes = {}
+    skipped = 0
+    for filename in filenames:
+        try:
+            melody = read_melody(filename, fast=True)[0]
+        except (OSError, ValueError, IndexError, EOFError):
+            skipped += 1
+            continue
+        pair_counter.update(tools.count_transitions(melody))
+        notes.update(dict.fromkeys(melody))
+    return pair_counter, list(notes), skipped
+
+
+def count_corpus(filenames, workers=None):
+
+    '''Counts the note pairs of the melodies of many midi files, in
+    chunks of FILES_PER_CHUNK files on a pool of *workers* processes
+    (all cores by default, no pool if workers == 1). Chunks are merged
+    in file order, so the output does not depend on the number of
+    workers. Output is a tuple (pair counter, notes, files skipped).'''
+
+    chunks = [filenames[i:i + FILES_PER_CHUNK]
+              for i in range(0, len(filenames), FILES_PER_CHUNK)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(chunks) < 2:
+        return merge_counts(map(count_file_transitions, chunks))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return merge_counts(executor.map(count_file_transitions, chunks))
+
+
+def merge_counts(results):
+
+    '''Component of count_corpus. Adds up the outputs of
+    count_file_transitions. Output is a tuple (pair counter, notes,
+    files skipped).'''
+
+    pair_counter = collections.Counter()
+    notes = {}
+    skipped = 0
+    for chunk_counter, chunk_notes, chunk_skipped in results:
+        pair_counter.update(chunk_counter)
+        notes.update(dict.fromkeys(chunk_notes))
+        skipped += chunk_skipped
+    return pair_counter, list(notes), skipped
+
+
+def train_corpus(directory, workers=None):
+
+    '''Trains a transition matrix on every midi file within a directory
+    (see count_corpus). Output is a tuple (matrix, files read, files
+    skipped).'''
+
+    filenames = find_midi_files(directory)
+    pair_counter, notes, skipped = count_corpus(filenames, workers)
+    matrix = tools.create_matrix_from_counts(pair_counter, notes)
+    return matrix, len(filenames) - skipped, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory', help='Directory of midi files to train on.')
+    parser.add_argument('output_file', help='Name of output midi file.')
+    parser.add_argument('--length', type=int, default=256,
+                        help='Sequence length (in notes).')
+    parser.add_argument('--workers', type=int,
+                        help='Number of processes (default: all cores).')
+    parser.add_argument('--seed', help='Seed of the generated sequence.')
+    args = parser.parse_args()
+    matrix, read, skipped = train_corpus(args.directory, args.workers)
+    print('Trained on {} files ({} skipped), {} note values.'.format(
+          read, skipped, len(matrix)))
+    if not matrix:
+        raise SystemExit('No notes found in {}.'.format(args.directory))
+    rng = random.Random(args.seed) if args.seed is not None else random
+    sequence = list(tools.generate_from_matrix(matrix, args.length, rng=rng))
+    write_midifile(args.output_file, [sequence], fast=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+'''Contains functions to play sequences in real time, as raw midi bytes
+written to a file descriptor (a midi device, a FIFO or a pipe) at the
+time of each event, instead of rendering them to a file first. Notes are
+generated by a separate thread, which stays at most *lookahead* notes
+ahead of playback, so endless sequences play in constant memory.
+
+Usage: python live_toolkit.py MIDI_FILE [--target PATH] [--length N]
+                              [--bpm BPM] [--seed SEED]'''
+
+import os
+import sys
+import time
+import queue
+import random
+import argparse
+import threading
+
+from midi_toolkit import read_melody, extract_delta_times
+import sequence_toolkit as tools
+
+
+TICKS_PER_BEAT = 480  # as written by write_midifile
+DEFAULT_TEMPO = 500000  # microseconds per beat (120 bpm), as written by write_midifile
+LOOKAHEAD = 64  # notes generated ahead of playback
+SPIN_SECONDS = 0.002  # the end of each wait is spent polling the clock
+PAUSE = (5,)
+END = 'end'  # marks the end of the sequence in the queue
+
+
+def encode_events(previous_chord, chord):
+
+    '''Component of stream_sequence. Returns the bytes played when a
+    chord starts: the note_offs of the previous chord, then the
+    note_ons of the new one. Pauses are silent.'''
+
+    data = bytearray()
+    if previous_chord != PAUSE:
+        for note in previous_chord:
+            data += bytes((0x80, note, 0))
+    if chord != PAUSE:
+        for note in chord:
+            data += bytes((0x90, note, 64))
+    return bytes(data)
+
+
+def wait_until(deadline):
+
+    '''Component of stream_sequence. Sleeps until shortly before a
+    time of the monotonic clock, then polls the clock until it is
+    reached, so that events are late by microseconds, not by the
+    granularity of sleep.'''
+
+    remaining = deadline - time.monotonic()
+    if remaining > SPIN_SECONDS:
+        time.sleep(remaining - SPIN_SECONDS)
+    while time.monotonic() < deadline:
+        pass
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def fill_queue(pairs, note_queue, stop):
+
+    '''Component of stream_sequence, run by the generating thread. Puts
+    (chord, delta time) pairs on a bounded queue, waiting while it is
+    full, then END. An exception raised by the generator is put on the
+    queue, to be raised again by the player.'''
+
+    try:
+        for pair in pairs:
+            while not stop.is_set():
+                try:
+                    note_queue.put(pair, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                return
+        note_queue.put(END)
+    except Exception as error:
+        note_queue.put(error)
+
+
+def stream_sequence(sequence, target, rhythms=False, tempo=DEFAULT_TEMPO,
+                    lookahead=LOOKAHEAD, stop=None):
+
+    '''Plays a sequence in real time. Takes a sequence (e.g. the
+    generator returned by generate_sequence), paired with delta times
+    by extract_delta_times, and a target: a file descriptor or the name
+    of a file, device or FIFO. Each chord's note_ons (and the previous
+    chord's note_offs) are written when its time comes, as measured by
+    the monotonic clock from the start of playback; tempo is in
+    microseconds per beat of TICKS_PER_BEAT ticks. Playback ends with
+    the sequence, or when the optional threading.Event *stop* is set
+    (by the caller: stream_sequence never sets it).
+    If generation falls behind, playback waits for it and carries on
+    from there (an underrun). Output is a dictionary of statistics:
+    events played, underruns and the mean and maximum lateness of events
+    (in seconds).'''
+
+    fd = target if isinstance(target, int) else os.open(target, os.O_WRONLY)
+    stop = stop or threading.Event()
+    halt = threading.Event()  # stops the generating thread
+    note_queue = queue.Queue(maxsize=lookahead)
+    producer = threading.Thread(target=fill_queue, daemon=True,
+                                args=(extract_delta_times(sequence, rhythms),
+                                      note_queue, halt))
+    seconds_per_tick = tempo / 1e6 / TICKS_PER_BEAT
+    stats = {'events': 0, 'underruns': 0, 'mean_late': 0.0, 'max_late': 0.0}
+    total_late = 0.0
+    chord = PAUSE
+    producer.start()
+    try:
+        item = note_queue.get()  # playback starts with the first chord
+        deadline = time.monotonic()
+        while item is not END and not stop.is_set():
+            if isinstance(item, Exception):
+                raise item
+            next_chord, delta_time = item
+            wait_until(deadline)
+            late = time.monotonic() - deadline
+            write_all(fd, encode_events(chord, next_chord))
+            chord = next_chord
+            stats['events'] += 1
+            total_late += late
+            stats['max_late'] = max(stats['max_late'], late)
+            deadline += delta_time * seconds_per_tick
+            try:
+                item = note_queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:  # generation fell behind playback
+                stats['underruns'] += 1
+                item = note_queue.get()
+                deadline = max(deadline, time.monotonic())
+        if not stop.is_set():
+            wait_until(deadline)  # the last chord lasts its delta time
+    finally:
+        halt.set()
+        write_all(fd, encode_events(chord, PAUSE))  # no note is left playing
+        if fd is not target:
+            os.close(fd)
+    if stats['events']:
+        stats['mean_late'] = total_late / stats['events']
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('midi_file', help='Name of origin midi file.')
+    parser.add_argument('--target', default='-',
+                        help='Midi device or FIFO to write to (default: '
+                             'stdout).')
+    parser.add_argument('--length', type=int, default=sys.maxsize,
+                        help='Sequence length (in notes, default: endless).')
+    parser.add_argument('--bpm', type=float, default=120,
+                        help='Tempo in beats per minute.')
+    parser.add_argument('--seed', help='Seed of the generated sequence.')
+    args = parser.parse_args()
+    melody = read_melody(args.midi_file, fast=True)[0]
+    rng = random.Random(args.seed) if args.seed is not None else random
+    target = sys.stdout.fileno() if args.target == '-' else args.target
+    try:
+        stats = stream_sequence(tools.generate_sequence(melody, args.length,
+                                                        rng),
+                                target, tempo=int(60e6 / args.bpm))
+    except KeyboardInterrupt:
+        return
+    print('{events} events, {underruns} underruns, lateness: mean '
+          '{mean_late:.6f}s, max {max_late:.6f}s.'.format(**stats),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
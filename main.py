@@ -1,12 +1,15 @@
 __author__ = 'Thomas Grossi, Matt Giannotti'
 __version__ = '0.9'
 
+import argparse
+
 from midi_toolkit import read_melody, read_rhythms, test_midi_filename
 from midi_toolkit import create_midi_file_list, write_midifile
 from midi_toolkit import list_midi_files_in_directory
 from mapping_toolkit import map_interface
-from sequences import create_mapseq, create_sparseseq, create_chordseq
+from sequences import iter_mapseq, iter_sparseseq, iter_chordseq
 import sequence_toolkit as tools
+from profiling_toolkit import enable_profiling, write_profiling_report
 
 
 def get_input_method():
@@ -72,12 +75,12 @@ def get_segment_size():
 
 def write_seq(melody):
     length = get_length()
-    return list(tools.generate_sequence(melody, length))
+    return tools.generate_sequence(melody, length)
 
 
 def write_mapseq(melody):
     map_file = map_interface()
-    return create_mapseq(melody, map_file)
+    return iter_mapseq(melody, map_file)
 
 
 def write_sparseseq(melody):
@@ -85,13 +88,13 @@ def write_sparseseq(melody):
     from_user = str(input('''Do you want the sequence to emerge from silence 
                       or to fade away? 1|2: '''))
     fading = False if from_user == '1' else True
-    return list(create_sparseseq(melody, int(length), fading))
+    return iter_sparseseq(melody, int(length), fading)
 
 
 def write_chordseq(melody):
     map_file = map_interface()
     increase = str(input('Chord Increase: '))
-    return create_chordseq(melody, map_file, int(increase))
+    return iter_chordseq(melody, map_file, int(increase))
 
 
 def write_groupseq(melody):
@@ -118,9 +121,11 @@ sequence_types = {'1': write_seq, '2': write_mapseq, '3': write_sparseseq,
                  '4': write_chordseq, '5': write_groupseq}
 
 
-def main():
+def main(profile=None):
+    if profile:
+        enable_profiling()
     input_method = get_input_method()
-    input_sequence = get_input_sequence(input_method)
+    input_sequence, _ = get_input_sequence(input_method)
     help_msg = ' '.join(('1 : Basic Sequence,',
                          '2 : Mapped Sequence,',
                          '3 : Sparse Sequence,',
@@ -138,7 +143,14 @@ def main():
         raise SystemExit
     output_name = get_output_name()
     output_type = input_method == read_rhythms
-    write_midifile(output_name, output_tracks, output_type)
+    write_midifile(output_name, output_tracks, output_type, fast=True)
+    if profile:
+        write_profiling_report(profile)
 
 if __name__== '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', nargs='?', const='-', metavar='REPORT',
+                        help='Write a JSON report of the time, calls, notes '
+                             'and memory of each stage to REPORT (default: '
+                             'stdout).')
+    main(parser.parse_args().profile)
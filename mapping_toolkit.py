@@ -1,14 +1,54 @@
 import os
-from midi_toolkit import read_melody, create_midi_file_list
+import ast
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from midi_toolkit import iter_tracks, create_midi_file_list
+from sequence_toolkit import create_translation_tables
+from cache_toolkit import LRUCache, file_key
+
+
+MAP_FIELDS = ('structure', 'sections', 'transitions', 'total_length',
+              'mapping')  # entries of a Map file, in order
+COMPILED_MAP_VERSION = 1
+MAP_CACHE = LRUCache(maxsize=32)  # validated Map objects, keyed by file_key
+POOL_MIN_BYTES = 1 << 18  # below this in total, starting a process pool costs more than it saves
+
+
+def build_mapping(midi_files, workers=None):
+
+    '''Builds the mapping of a Map from a list of midi files, one for
+    each section (A, B, C...), with read_section_notes. The files are
+    read on a pool of *workers* processes, never more than there are
+    files. By default the pool uses all cores, and is only started when
+    the files add up to POOL_MIN_BYTES; an explicit workers > 1 always
+    uses a pool, and workers == 1 reads the files in this process. Files read on a pool are only cached on disk (see
+    set_parse_cache), not in this process.'''
+
+    if workers is None:
+        total_size = sum(os.path.getsize(file_name) for file_name in midi_files)
+        workers = (os.cpu_count() or 1) if total_size >= POOL_MIN_BYTES else 1
+    workers = min(workers, len(midi_files))
+    if workers <= 1:
+        section_values = list(map(read_section_notes, midi_files))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            section_values = list(executor.map(read_section_notes, midi_files))
+    return {chr(i + 65): values for i, values in enumerate(section_values)}
+
+
+def read_section_notes(file_name):
 
+    '''Component of build_mapping. Returns the note values of the
+    first track of a midi file that has notes (skipping e.g. a tempo
+    track), in order of appearance. Tracks are decoded one at a time,
+    and the ones after it are never decoded; tracks already in the parse
+    cache are not decoded at all (see iter_tracks).'''
 
-def build_mapping(midi_files):
-    data = {}
-    for i, file_name in enumerate(midi_files):
-        section_letter = chr(i + 65)
-        section_values = create_ordered_set(read_melody(file_name)[0])  # only takes first track
-        data[section_letter] = section_values
-    return data
+    for _, table in iter_tracks(file_name):
+        if len(table):
+            return create_ordered_set(table.melody())
+    return []
 
 
 def create_ordered_set(sequence):
@@ -16,11 +56,7 @@ def create_ordered_set(sequence):
     '''Creates a list containing each unique element
     of input sequence, preserving order of appearance.'''
     
-    final = []
-    for item in sequence:
-        if item not in final:
-            final.append(item)
-    return final
+    return list(dict.fromkeys(sequence))
 
 
 def read_map_file(filename):
@@ -31,20 +67,53 @@ def read_map_file(filename):
     and use the *write_map_file* method to generate a suitable file, or run
     *mapping_toolkit.py* after changing the settings of its *main* function.
     You will need a list of midi files, which correspond to the sections, and 
-    a structure.'''
+    a structure. Values are read as Python literals, never executed.
+    Compiled maps (.json files, see *write_compiled_map*) are also accepted.'''
     
+    if filename.endswith('.json'):
+        return read_compiled_map(filename)
+    values = {}
     with open(filename, 'r') as f:
-        output = []
-        for line in f.readlines():
-            if line.startswith('#'):
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
                 continue
-            if line.endswith('\n'):
-                line = line[:-1]
-            output.append(eval(line.split(' = ')[1]))
-    map_data = debug_read_map_file(*tuple(output))
+            name, separator, value = line.partition(' = ')
+            if not separator or name not in MAP_FIELDS or name in values:
+                raise ValueError('Invalid line {} in Map file {}: {}'.format(
+                                 line_number, filename, line))
+            try:
+                values[name] = ast.literal_eval(value)
+            except (ValueError, TypeError, SyntaxError, MemoryError,
+                    RecursionError):
+                raise ValueError('Invalid value on line {} of Map file {}.'
+                                 .format(line_number, filename))
+    missing = [name for name in MAP_FIELDS if name not in values]
+    if missing:
+        raise ValueError('Map file {} is missing: {}.'.format(filename,
+                                                             missing))
+    map_data = debug_read_map_file(*(values[name] for name in MAP_FIELDS))
     return map_data
 
 
+def read_compiled_map(filename):
+
+    '''Reads a Map saved by *write_compiled_map*. Returns the same
+    information as read_map_file.'''
+
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or data.get('version') != COMPILED_MAP_VERSION:
+        raise ValueError('{} is not a compiled Map file.'.format(filename))
+    try:
+        mapping = {section: [tuple(note_value) for note_value in notes]
+                   for section, notes in data['mapping'].items()}
+        return debug_read_map_file(data['structure'], data['sections'],
+                                   data['transitions'], None, mapping)
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError('{} is not a compiled Map file.'.format(filename))
+
+
 class Map(object):
 
     def __init__(self, structure, sections, transitions, mapping):
@@ -53,6 +122,7 @@ class Map(object):
         self.transitions = transitions
         self.length = sum(sections + transitions)
         self.mapping = mapping
+        self.tables = create_translation_tables(mapping)  # section to {note in A: note in section}
 
     @classmethod
     def from_midi_files(cls, midi_files, structure, section_length,
@@ -68,8 +138,32 @@ class Map(object):
 
     @classmethod
     def from_map_file(cls, filename):
-        data = read_map_file(filename)
-        return cls(*data)
+
+        '''Reads a Map file (see read_map_file). Files are read and
+        validated once, until they change; each call returns its own
+        copy, so that changes made by one caller are not seen by others.'''
+
+        key = (cls, file_key(filename))
+        map_data = MAP_CACHE.get(key)  # validated Map objects, never handed out
+        if map_data is None:
+            map_data = cls(*read_map_file(filename))
+            MAP_CACHE.put(key, map_data)
+        return map_data.copy()
+
+    def copy(self):
+
+        '''Returns a copy of the Map with its own lists and dictionaries
+        (note values are tuples, and are shared).'''
+
+        duplicate = object.__new__(type(self))  # tables are copied, not rebuilt
+        duplicate.__dict__.update(self.__dict__)
+        duplicate.sections = list(self.sections)
+        duplicate.transitions = list(self.transitions)
+        duplicate.mapping = {section: list(notes)
+                             for section, notes in self.mapping.items()}
+        duplicate.tables = {section: table if table is None else dict(table)
+                            for section, table in self.tables.items()}
+        return duplicate
 
     def write_map_file(self, output_file='Nameless_Map.txt'):
         with open(output_file, 'w') as f:
@@ -80,6 +174,14 @@ class Map(object):
                     .format(self.structure, self.sections, self.transitions,
                             self.length, self.mapping))
 
+    def write_compiled_map(self, output_file='Nameless_Map.json'):
+        with open(output_file, 'w') as f:
+            json.dump({'version': COMPILED_MAP_VERSION,
+                       'structure': self.structure,
+                       'sections': self.sections,
+                       'transitions': self.transitions,
+                       'mapping': self.mapping}, f)
+
     def __iter__(self):
         return (var for var in (self.structure, self.sections, self.transitions,
                             self.mapping))
@@ -133,6 +235,22 @@ def map_interface():
 # Debugger functions
 
 def debug_read_map_file(structure, sections, transitions, length, mapping):
+    if not isinstance(structure, str):
+        raise TypeError('*structure* must be a string!')
+    for lengths in (sections, transitions):
+        if not isinstance(lengths, list) or not all(
+                type(value) == int and value >= 0 for value in lengths):
+            raise TypeError('*sections* and *transitions* must be lists of'
+                            ' numbers of notes!')
+    if not isinstance(mapping, dict) or not mapping:
+        raise TypeError('*mapping* must be a dictionary of sections!')
+    for value in mapping.values():
+        if not isinstance(value, list) or not all(
+                isinstance(note_value, tuple) and note_value and
+                all(type(note) == int and 0 <= note < 128 for note in note_value)
+                for note_value in value):
+            raise TypeError('Entries in *mapping* must be lists of note'
+                            ' values!')
     for value in mapping.values():
         if len(value) != len(list(mapping.values())[0]):
             raise ValueError('Entries in *mapping* must have same length!')
@@ -177,8 +295,8 @@ def test_map_file(map_name):
     '''Takes the name of a Map file as input, tests to see
     if the file exists in your directory.'''
 
-    if map_name[-4:] != '.txt':
-        print('''File name must include .txt extension.''')
+    if map_name[-4:] != '.txt' and map_name[-5:] != '.json':
+        print('''File name must include .txt (or .json) extension.''')
         raise SystemExit()
     try:
         open(map_name, 'r')
@@ -3,121 +3,361 @@ write values into midi files.'''
 
 import random
 import os
+import pickle
+import collections
+from array import array
+import hashlib
 
 from mido import Message, MidiFile, MidiTrack, MetaMessage
 
+from smf_toolkit import read_smf_file, write_smf_file, map_smf_file
+from smf_toolkit import read_smf_chunks, decode_track, select_tracks
+from cache_toolkit import LRUCache, file_key
+from compact_sequence import NoteSequence
+import profiling_toolkit
+from profiling_toolkit import profiled
 
-def match_note_offs(note_off, note_ons, time, ticks):
-    
-    '''Closes an "open" note, by identifying which
-    of the current "note on" messages has the same note
-    value as the input "note off". Returns the note with
-    an added "note off" time and removes the "note on"
-    from the list.'''
-    
-    i = 0
-    while i < len(note_ons):
-        chord = note_ons[i]
-        if chord[0] == note_off.note:
-            note_ons.remove(chord)
-            return chord + [time]
-        else:
-            i += 1
 
+PARSE_CACHE = LRUCache(maxsize=64)  # parsed files, keyed by file_key
+PARSE_CACHE_DIR = os.environ.get('NOTESEQ_CACHE_DIR')  # None disables the on-disk cache
+PARSE_CACHE_VERSION = 4  # change whenever the output of parse_midifile changes
 
-def convert_group_to_chord(group, ticks):
+
+def match_note_offs(note_value, channel, note_ons, time):
     
-    '''Takes a group of notes with the same starting
-    and ending time and builds a chord out of them
-    ((note1, note2), delta_time). Groups with one element
-    become single notes (tuples with 1 element).'''
+    '''Closes an "open" note. note_ons maps (channel, note value)
+    to the start times of the notes still open on that channel and
+    pitch, oldest first. Removes the oldest one and returns the
+    note with an added "note off" time, or None if there is no
+    matching "note on".'''
     
-    note_values = tuple([note[0] for note in group])
-    delta_time = group[0][2] - group[0][1]
-    delta_time = int(round(delta_time / ticks * 240))
-    return (note_values, (delta_time,))
-
-
-def group_notes_into_chords(note_list, ticks):
-    '''Takes a list of notes and returns a list of
-    lists. Each sublist contains notes that have
-    the same start time and end time (thus belong
-    in a chord).'''
-    output = []
-    group = []
-    for i, note in enumerate(note_list[:-1]):
-        next_note = note_list[i + 1]
-        if note[1:] == next_note[1:]:
-            group.append(note)
-        else:
-            group.append(note)
-            output.append(convert_group_to_chord(group, ticks))
-            group = []
-    group.append(note_list[-1])
-    output.append(convert_group_to_chord(group, ticks))
-    return output
+    starts = note_ons.get((channel, note_value))
+    if not starts:
+        return None
+    return [note_value, starts.popleft(), time]
 
 
-def read_midifile(filename):
-    
-    '''Extracts note values and delta times from a midi file.'''
+class NoteTable(object):
+
+    '''Columnar record of the notes of a midi file: parallel arrays of
+    pitch, onset, offset (in ticks), channel and track, with one entry
+    per note. Pauses are stored with pitch 5 and PAUSE_CHANNEL. Notes are
+    grouped into chords (same onset and offset) only once, on demand,
+    and read_midifile, read_melody and read_rhythms are derived from
+    the table without building intermediate note lists.'''
+
+    PAUSE_CHANNEL = 0xFF
+
+    __slots__ = ('ticks', 'pitches', 'onsets', 'offsets', 'channels',
+                 'tracks', '_chords')
+
+    def __init__(self, ticks):
+        self.ticks = float(ticks)
+        self.pitches = array('B')
+        self.onsets = array('q')
+        self.offsets = array('q')
+        self.channels = array('B')
+        self.tracks = array('H')
+        self._chords = None
+
+    def append(self, pitch, onset, offset, channel, track):
+        self.pitches.append(pitch)
+        self.onsets.append(onset)
+        self.offsets.append(offset)
+        self.channels.append(channel)
+        self.tracks.append(track)
+        self._chords = None
+
+    def append_pause(self, onset, offset, track):
+        self.append(5, onset, offset, self.PAUSE_CHANNEL, track)
+
+    @profiled('chord_grouping', count_notes=lambda chords: len(chords[0]))
+    def group_chords(self):
+
+        '''Sorts the notes by onset (keeping the order in which they
+        were added for equal onsets) and groups consecutive notes with
+        the same onset and offset into chords. Pauses are never grouped
+        with notes. Returns a tuple (order, bounds): the notes of chord
+        i are order[bounds[i]:bounds[i + 1]].'''
+
+        if self._chords is None:
+            onsets, offsets = self.onsets, self.offsets
+            pauses = [channel == self.PAUSE_CHANNEL
+                      for channel in self.channels]
+            order = array('L', sorted(range(len(onsets)),
+                                      key=onsets.__getitem__))
+            bounds = array('L', [0])
+            previous = None
+            for position, i in enumerate(order):
+                key = (onsets[i], offsets[i], pauses[i])
+                if key != previous and position:
+                    bounds.append(position)
+                previous = key
+            if order:
+                bounds.append(len(order))
+            self._chords = order, bounds
+        return self._chords
+
+    def iter_chords(self):
+
+        '''Yields a (note values, (delta time,)) pair for each chord,
+        as found in the output of read_midifile. Delta times are
+        scaled to 240 ticks per beat.'''
+
+        order, bounds = self.group_chords()
+        pitches, onsets, offsets = self.pitches, self.onsets, self.offsets
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            first = order[start]
+            delta_time = (offsets[first] - onsets[first]) / self.ticks
+            yield (tuple(pitches[i] for i in order[start:end]),
+                   (int(round(delta_time * 240)),))
+
+    def melody(self):
+
+        '''Yields the note value of each chord (see read_melody).'''
+
+        order, bounds = self.group_chords()
+        pitches = self.pitches
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield tuple(pitches[i] for i in order[start:end])
+
+    def rhythms(self):
+
+        '''Yields the delta time of each chord, preceded by 5 for
+        pauses (see read_rhythms).'''
+
+        for note_value, delta_time in self.iter_chords():
+            yield note_value + delta_time if note_value == (5,) else delta_time
+
+    def to_note_sequence(self):
+
+        '''Returns the chords and their delta times as a NoteSequence.'''
+
+        return NoteSequence.from_pairs(self.iter_chords())
+
+    def __len__(self):
+        return len(self.pitches)
+
+    def __repr__(self):
+        return 'NoteTable({} notes, {} ticks per beat)'.format(len(self),
+                                                               self.ticks)
+
+
+def set_parse_cache(maxsize=64, cache_dir=None):
+
+    '''Configures the cache used by read_midifile. Takes the number of
+    parsed files kept in memory and an optional directory where parsed
+    files are also stored, so that each file is decoded only once ever.'''
+
+    global PARSE_CACHE_DIR
+    PARSE_CACHE.maxsize = maxsize
+    PARSE_CACHE.clear()
+    PARSE_CACHE_DIR = cache_dir
+
+
+def read_note_table(filename, fast=False, tracks=None):
+
+    '''Extracts the notes of a midi file as a NoteTable. Parsed
+    files are cached by path, size and modification time, in memory
+    and optionally on disk (see set_parse_cache), so each file is
+    decoded once per process. With fast = True the file is decoded
+    directly from its bytes by smf_toolkit, instead of being loaded
+    with mido. If tracks (a track number or a collection of track
+    numbers) is given, only the notes of those tracks are read. The
+    returned table is shared and must not be modified.'''
+
+    key = file_key(filename)
+    tracks = select_tracks(tracks)
+    if tracks is not None:
+        key += (tuple(sorted(tracks)),)
+    return _cached_table(key, lambda: parse_midifile(filename, fast, tracks))
+
+
+def _cached_table(key, parse):
+
+    '''Component of read_note_table and iter_tracks. Returns the table
+    of a key from memory, then from the on-disk cache, or else from
+    parse() (a function without arguments), storing it in both.'''
+
+    table = PARSE_CACHE.get(key)
+    if table is None:
+        table = _load_parse_cache(key)
+        if table is None:
+            table = parse()
+            _store_parse_cache(key, table)
+        PARSE_CACHE.put(key, table)
+    return table
+
+
+def read_midifile(filename, fast=False, tracks=None):
     
-    output = []
+    '''Extracts note values and delta times from a midi file
+    (see read_note_table).'''
+
+    return [list(read_note_table(filename, fast, tracks).iter_chords())]
+
+
+def _parse_cache_path(key):
+
+    '''Returns the path of the on-disk cache entry of a file key.'''
+
+    digest = hashlib.sha1(repr((PARSE_CACHE_VERSION, key)).encode())
+    return os.path.join(PARSE_CACHE_DIR, digest.hexdigest() + '.pickle')
+
+
+def _load_parse_cache(key):
+
+    '''Reads a parsed file from the on-disk cache. Returns None when
+    the cache is disabled or has no valid entry for the key. Entries
+    are pickles, and loading a pickle can run arbitrary code: the cache
+    directory must only be writable by trusted users. Entries that
+    cannot be loaded (truncated, or written by another version of the
+    code) are ignored, and the file is parsed again.'''
+
+    if not PARSE_CACHE_DIR:
+        return None
+    try:
+        with open(_parse_cache_path(key), 'rb') as f:
+            table = pickle.load(f)
+    except Exception:  # e.g. AttributeError or ImportError from a stale entry
+        return None
+    return table if isinstance(table, NoteTable) else None
+
+
+def _store_parse_cache(key, data):
+
+    '''Writes a parsed file to the on-disk cache, if enabled.'''
+
+    if not PARSE_CACHE_DIR:
+        return
+    os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+    path = _parse_cache_path(key)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)  # atomic, other processes never see partial files
+
+
+@profiled('midi_parse', count_notes=len)
+def parse_midifile(filename, fast=False, tracks=None):
+
+    '''Component of read_note_table. Decodes a midi file (or only the
+    given track numbers) into a NoteTable, without caching.'''
+
+    if fast:
+        ticks, events = read_smf_file(filename, tracks)
+    else:
+        ticks, events = read_mido_events(filename, tracks)
+    table = NoteTable(ticks)
+    for track_number, track in enumerate(events):
+        parse_track(table, track, track_number)
+    return table
+
+
+def parse_track(table, events, track_number, note_limit=None):
+
+    '''Component of parse_midifile and iter_tracks. Adds the notes and
+    pauses of the events of one track to a NoteTable. Times start from
+    0 in each track, as every track of a midi file starts at the
+    beginning of the song. If note_limit is given, events are read
+    only until that many notes have ended. Output is the table.'''
+
     time = 0
-    current_note_ons = []
-    finished_notes = []
+    notes = 0
+    current_note_ons = collections.defaultdict(collections.deque)
+    for delta, kind, note_value, velocity, channel in events:
+        if delta == 1:
+            delta = 0  # fix for bug introduced by Musescore
+        if kind == 'note_on' and velocity and delta:
+            table.append_pause(time, time + delta, track_number)
+        time += delta
+        if kind == 'note_on' and velocity:
+            current_note_ons[channel, note_value].append(time)
+        elif kind == 'note_on' or kind == 'note_off':
+            note = match_note_offs(note_value, channel, current_note_ons, time)
+            if note:  # note offs without a note on are ignored
+                table.append(note[0], note[1], note[2], channel, track_number)
+                notes += 1
+                if notes == note_limit:
+                    break
+    return table
+
+
+def iter_tracks(filename, tracks=None, note_limit=None, fast=True):
+
+    '''Reads the tracks of a midi file one at a time, each as its own
+    NoteTable. Takes an optional track selector (a track number or a
+    collection of track numbers, every track by default) and note_limit
+    (see parse_track). With fast = True, the chunks of unselected tracks
+    are skipped without being decoded, and each track is decoded only
+    when the generator reaches it, so a caller that stops early never
+    decodes the rest of the file. Tracks read in full are cached like
+    read_note_table(filename, tracks=track number), and share its
+    entries, so cached tracks are not decoded again; tables must not be
+    modified. Output is a generator of (track number, NoteTable) tuples.'''
+
+    tracks = select_tracks(tracks)
+    key = file_key(filename)
+    if not fast:  # mido decodes the whole file anyway
+        ticks, events = read_mido_events(filename, tracks)
+        for track_number, track in enumerate(events):
+            if tracks is None or track_number in tracks:
+                yield track_number, _read_track(
+                    key, track_number, note_limit,
+                    lambda: parse_track(NoteTable(ticks), track,
+                                        track_number, note_limit))
+        return
+    with map_smf_file(filename) as data:
+        ticks, chunks = read_smf_chunks(data)
+        for track_number, (start, end) in enumerate(chunks):
+            if tracks is None or track_number in tracks:
+                yield track_number, _read_track(
+                    key, track_number, note_limit,
+                    lambda: parse_track(NoteTable(ticks),
+                                        decode_track(data, start, end),
+                                        track_number, note_limit))
+
+
+def _read_track(key, track_number, note_limit, parse):
+
+    '''Component of iter_tracks. Returns the cached table of a track,
+    or parse() for tracks cut short by note_limit, which are not
+    cached.'''
+
+    if note_limit is not None:
+        return parse()
+    return _cached_table(key + ((track_number,),), parse)
+
+
+def read_mido_events(filename, tracks=None):
+
+    '''Loads a midi file with mido. Returns a tuple (ticks_per_beat,
+    tracks) in the same format as smf_toolkit.read_smf_file.'''
+
+    tracks = select_tracks(tracks)
     with MidiFile(filename) as f:
-        ticks = float(f.ticks_per_beat)
-        for track in f.tracks:
-            for msg in track:
-                if msg.time == 1:
-                    msg.time = 0  # fix for bug introduced by Musescore
-                if msg.type == 'note_on' and msg.velocity and msg.time:
-                    time_off = time + msg.time
-                    note = (5, time, time_off)
-                    finished_notes.append(note)
-                time += msg.time
-                if msg.type == 'note_on' and msg.velocity:
-                    note_on = [msg.note, time]
-                    current_note_ons.append(note_on)
-                elif msg.type == 'note_on' and not msg.velocity:
-                    note = match_note_offs(msg, current_note_ons, time, ticks)
-                    finished_notes.append(note)
-                elif msg.type == 'note_off':
-                    note = match_note_offs(msg, current_note_ons, time, ticks)
-                    finished_notes.append(note)
-        finished_notes = sorted(finished_notes, key=lambda x: x[1])
-        output.append(group_notes_into_chords(finished_notes, ticks))
-    return output
-
-
-def read_melody(filename):
+        events = [[(msg.time, msg.type, msg.note, msg.velocity, msg.channel)
+                   if msg.type in ('note_on', 'note_off')
+                   else (msg.time, None, None, None, None) for msg in track]
+                  if tracks is None or i in tracks else []
+                  for i, track in enumerate(f.tracks)]
+        return f.ticks_per_beat, events
+
+
+def read_melody(filename, fast=False, tracks=None):
     
     '''Extracts melody from a midi file, which can be used
      as input by current Sequences.'''
     
-    data = read_midifile(filename)
-    final_melody = []
-    return [[note_value for note_value, delta_time in track] for track in data]
+    return [list(read_note_table(filename, fast, tracks).melody())]
 
 
-def read_rhythms(filename):
+def read_rhythms(filename, fast=False, tracks=None):
     
     '''Extracts delta times from a midi file, which can
      be used as input by current Sequences.'''
     
-    data = read_midifile(filename)
-    rhythms = []
-    for track in data:
-        new_track = []
-        for note_value, delta_time in track:
-            if note_value == (5,):  # (5,) is pauses
-                new_track.append(note_value + delta_time)
-            else:
-                new_track.append(delta_time)
-        rhythms.append(new_track)
-    return rhythms
-    # return [[delta_time for note_value, delta_time in data[track]]]
+    return [list(read_note_table(filename, fast, tracks).rhythms())]
 
 
 def test_midi_filename(midi_file_name):
@@ -170,10 +410,13 @@ def extract_delta_times(sequence, rhythms):
     time values (default 240). If rhythms contains integer
     values, the default delta time of 240 is multiplied by a
     factor of one of the integers (chosen at random).
-    Returns a list of (note value, delta time) pairs'''
+    Returns a list of (note value, delta time) pairs. A NoteSequence
+    with durations is paired with its own delta times.'''
     
     index = 0
-    if rhythms:
+    if isinstance(sequence, NoteSequence) and sequence.durations is not None:
+        yield from sequence.timed()
+    elif rhythms:
         for delta_time in sequence:
             if len(delta_time) == 2:  # (pause, delta time)
                 yield (5,), delta_time[1]
@@ -184,15 +427,25 @@ def extract_delta_times(sequence, rhythms):
             yield chord, 240
 
 
-def write_midifile(filename, sequence, rhythms=False):
+@profiled('midi_write', counted=False)  # notes are counted as they are written
+def write_midifile(filename, sequence, rhythms=False, fast=False):
     
     '''Takes a Sequence and writes it to a midi file. In default
     mode, with rhythms = False, it expects a sequence of notes or
     chords. With rhythms set to True, it expects a sequence of
-    delta times.'''
+    delta times. With fast = True the events are encoded straight
+    to the file by smf_toolkit as the sequence is consumed, so
+    generators are never held in memory.'''
     
+    tracks = (extract_delta_times(seq, rhythms) for seq in sequence)
+    if profiling_toolkit.ENABLED:
+        tracks = (profiling_toolkit.count_items('midi_write', pairs)
+                  for pairs in tracks)
+    if fast:
+        write_smf_file(filename, tracks)
+        return
     with MidiFile() as outfile:
-        for seq in sequence:
+        for pairs in tracks:
             track = MidiTrack()
             outfile.tracks.append(track)
             track.append(
@@ -212,7 +465,7 @@ def write_midifile(filename, sequence, rhythms=False):
                 Message('control_change', channel=0, control=10, value=63, time=0))
             track.append(
                 Message('control_change', channel=0, control=7, value=98, time=0))
-            for chord, delta_time in extract_delta_times(seq, rhythms):
+            for chord, delta_time in pairs:
                 for note in chord:
                     track.append(Message('note_on', channel=0, note=note,
                                          velocity=64, time=0))
@@ -0,0 +1,265 @@
+'''Contains TransitionModel, a transition matrix stored as arrays which can
+be saved to a file and memory-mapped back, so that generation processes
+start without re-reading and re-counting the source midi files, and share
+the pages of the file instead of each holding its own copy.
+
+Usage: python model_toolkit.py SOURCE MODEL_FILE [--workers N]
+(SOURCE is a midi file, or a directory of midi files trained with
+corpus_toolkit.py)'''
+
+import os
+import sys
+import json
+import mmap
+import random
+import struct
+import bisect
+import argparse
+from array import array
+
+import corpus_toolkit
+import sequence_toolkit as tools
+from midi_toolkit import read_melody
+from cache_toolkit import LRUCache, file_key
+from profiling_toolkit import profiled_generator
+
+
+MODEL_MAGIC = b'NSEQMODL'
+MODEL_VERSION = 1
+MODEL_HEADER = struct.Struct('<8sIIQQ')  # magic, version, states, transitions, state table size
+ALIGNMENT = 8
+MODEL_CACHE = LRUCache(16)
+
+
+class TransitionModel(object):
+
+    '''Transition matrix in compressed sparse row form. Note values are
+    encoded as state numbers (their position in states). The
+    transitions of state i are indptr[i]:indptr[i + 1] within indices
+    (next states) and cumulative (cumulative probabilities), and
+    sources[i] is the state whose transitions are used for state i (a
+    state with no followers borrows those of the state with most
+    followers, as in compile_matrix). Models loaded from a file read
+    the arrays straight from the memory-mapped file.'''
+
+    __slots__ = ('states', 'index', 'indptr', 'indices', 'cumulative',
+                 'sources', 'filename', '_mapping')
+
+    def __init__(self, states, indptr, indices, cumulative, sources,
+                 filename=None, mapping=None):
+        self.states = states
+        self.index = {note: state for state, note in enumerate(states)}
+        self.indptr = indptr
+        self.indices = indices
+        self.cumulative = cumulative
+        self.sources = sources
+        self.filename = filename
+        self._mapping = mapping
+
+    @classmethod
+    def from_matrix(cls, matrix):
+
+        '''Builds a model from a transition matrix (see
+        create_transition_matrix). States keep the order of the matrix,
+        so that the model generates the same sequences as the matrix
+        for the same random number generator.'''
+
+        states = list(matrix)
+        index = {note: state for state, note in enumerate(states)}
+        indptr = array('q', [0])
+        indices = array('i')
+        cumulative = array('d')
+        sources = array('i', range(len(states)))
+        for note, transitions in matrix.items():
+            total = 0
+            for next_note, probability in transitions:
+                total += probability  # accumulated as in compile_matrix
+                indices.append(index[next_note])
+                cumulative.append(total)
+            indptr.append(len(indices))
+        if matrix:
+            fallback = index[max(matrix, key=lambda x: len(matrix[x]))]
+            for state, note in enumerate(states):
+                if not matrix[note]:  # fix for notes with no followers
+                    sources[state] = fallback
+        return cls(states, indptr, indices, cumulative, sources)
+
+    @classmethod
+    def from_melody(cls, melody):
+        return cls.from_matrix(tools.create_transition_matrix(melody))
+
+    @classmethod
+    def load(cls, filename):
+
+        '''Opens a model file written by save. The arrays are views of
+        the memory-mapped file, which stays open until close is called.'''
+
+        with open(filename, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, n_states, n_transitions, table_size = \
+                MODEL_HEADER.unpack_from(mapping)
+            if magic != MODEL_MAGIC:
+                raise ValueError('{} is not a model file.'.format(filename))
+            if version != MODEL_VERSION:
+                raise ValueError('{} has model version {} (expected {}).'.format(
+                                 filename, version, MODEL_VERSION))
+            position = MODEL_HEADER.size
+            table = json.loads(bytes(mapping[position:position + table_size]))
+            states = [tuple(note) if isinstance(note, list) else note
+                      for note in table]
+            position = _align(position + table_size)
+            arrays = []
+            for typecode, count in (('q', n_states + 1), ('i', n_transitions),
+                                    ('d', n_transitions), ('i', n_states)):
+                size = array(typecode).itemsize * count
+                arrays.append(_read_array(mapping, position, size, typecode))
+                position = _align(position + size)
+        except Exception:
+            mapping.close()
+            raise
+        return cls(states, *arrays, filename=os.path.abspath(filename),
+                   mapping=mapping)
+
+    @classmethod
+    def from_model_file(cls, filename):
+
+        '''Like load, but models are loaded once per process and shared
+        until their file changes.'''
+
+        key = (cls, file_key(filename))
+        model = MODEL_CACHE.get(key)
+        if model is None:
+            model = cls.load(filename)
+            MODEL_CACHE.put(key, model)
+        return model
+
+    def save(self, filename):
+
+        '''Writes the model to a file: a header, the state table (as
+        JSON) and the arrays (little-endian), each aligned to 8 bytes.'''
+
+        table = json.dumps([list(note) if isinstance(note, tuple) else note
+                            for note in self.states]).encode()
+        with open(filename, 'wb') as f:
+            f.write(MODEL_HEADER.pack(MODEL_MAGIC, MODEL_VERSION,
+                                      len(self.states), len(self.indices),
+                                      len(table)))
+            f.write(table)
+            for values, typecode in ((self.indptr, 'q'), (self.indices, 'i'),
+                                     (self.cumulative, 'd'), (self.sources, 'i')):
+                f.write(bytes(-f.tell() % ALIGNMENT))
+                values = array(typecode, values)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                f.write(values.tobytes())
+
+    def close(self):
+        if self._mapping is not None:
+            for name in ('indptr', 'indices', 'cumulative', 'sources'):
+                values = getattr(self, name)
+                if isinstance(values, memoryview):
+                    values.release()
+                setattr(self, name, None)
+            self._mapping.close()
+            self._mapping = None
+
+    @profiled_generator('sampling')
+    def generate(self, length, note=None, rng=random):
+
+        '''Builds a note sequence, like generate_from_matrix. Takes a
+        length (in notes), an optional first note (a random note of the
+        model by default) and random number generator. Output is a
+        generator.'''
+
+        states = self.states
+        indptr, indices = self.indptr, self.indices
+        cumulative, sources = self.cumulative, self.sources
+        if note is None:
+            note = rng.choice(states)
+        state = self.index[note]
+        repetitions = 0
+        limit_rep = len(states) > 1  # one note on repeat otherwise
+        for i in range(length):
+            source = sources[state]
+            start, stop = indptr[source], indptr[source + 1]
+            if limit_rep and repetitions == 2:  # *note* appeared three times in a row
+                no_rep = [option for option in indices[start:stop]
+                          if option != source]
+                if no_rep:
+                    state = rng.choice(no_rep)
+                    repetitions = 0
+                    yield states[state]
+                    continue
+            rand = rng.random() * cumulative[stop - 1]  # guards against rounding
+            state = indices[bisect.bisect_right(cumulative, rand, start, stop)]
+            repetitions = repetitions + 1 if state == source else 0
+            yield states[state]
+
+    def to_matrix(self):
+
+        '''Decodes the model back into a transition matrix.'''
+
+        matrix = {}
+        for state, note in enumerate(self.states):
+            start, stop = self.indptr[state], self.indptr[state + 1]
+            previous = 0
+            matrix[note] = []
+            for i in range(start, stop):
+                matrix[note].append((self.states[self.indices[i]],
+                                     self.cumulative[i] - previous))
+                previous = self.cumulative[i]
+        return matrix
+
+    def __reduce__(self):  # loaded models are sent to other processes by name
+        if self._mapping is not None:
+            return TransitionModel.load, (self.filename,)
+        return TransitionModel, (self.states, array('q', self.indptr),
+                                 array('i', self.indices),
+                                 array('d', self.cumulative),
+                                 array('i', self.sources))
+
+    def __len__(self):
+        return len(self.states)
+
+    def __repr__(self):
+        if self.indices is None:
+            return 'TransitionModel(closed, file={!r})'.format(self.filename)
+        return 'TransitionModel(states={}, transitions={}{})'.format(
+                len(self.states), len(self.indices),
+                ', file={!r}'.format(self.filename) if self.filename else '')
+
+
+def _align(position):
+    return position + -position % ALIGNMENT
+
+
+def _read_array(mapping, position, size, typecode):
+    if sys.byteorder == 'big':  # the file is little-endian: copy and swap
+        values = array(typecode, mapping[position:position + size])
+        values.byteswap()
+        return values
+    return memoryview(mapping)[position:position + size].cast(typecode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('source', help='Midi file or directory of midi files.')
+    parser.add_argument('model_file', help='Name of output model file.')
+    parser.add_argument('--workers', type=int,
+                        help='Number of processes used to read a directory.')
+    args = parser.parse_args()
+    if os.path.isdir(args.source):
+        matrix, read, skipped = corpus_toolkit.train_corpus(args.source,
+                                                            args.workers)
+        print('Trained on {} files ({} skipped).'.format(read, skipped))
+    else:
+        matrix = tools.create_transition_matrix(
+                    read_melody(args.source, fast=True)[0])
+    model = TransitionModel.from_matrix(matrix)
+    model.save(args.model_file)
+    print('Saved {!r} to {}.'.format(model, args.model_file))
+
+
+if __name__ == '__main__':
+    main()
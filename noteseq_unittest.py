@@ -1,10 +1,34 @@
 '''Unit tests for sequence_toolkit'''
 
+import io
+import json
+import asyncio
+import os
+import random
+import itertools
+import collections
+import tempfile
+import threading
+import tracemalloc
 import midi_toolkit
 import sequence_toolkit as tools
+import sequences
+import corpus_toolkit
+import batch
+import server
+import mapping_toolkit
 import unittest
+import profiling_toolkit
+from compact_sequence import NoteSequence
+from model_toolkit import TransitionModel
+from live_toolkit import stream_sequence
+try:
+    import array_toolkit
+except ImportError:  # NumPy is optional
+    array_toolkit = None
 
 MELODY = midi_toolkit.read_melody('151.mid')[0]  # first track
+PRIME = midi_toolkit.read_melody('1Prime.mid')[0]  # notes of section A of Map10.txt
 
 
 class TestTransitionMatrix(unittest.TestCase):
@@ -32,8 +56,178 @@ class TestTransitionMatrix(unittest.TestCase):
 
     def test_empty_list(self):
         self.assertEqual(tools.create_transition_matrix([]), {})
+
+    def test_note_sequence(self):
+        self.assertEqual(tools.create_transition_matrix(NoteSequence(MELODY)),
+                         tools.create_transition_matrix(MELODY))
+
+    def test_merged_counts(self):
+        counts = (tools.count_transitions([1, 2, 3]) +
+                  tools.count_transitions([3, 1, 2]))
+        self.assertEqual(tools.create_matrix_from_counts(counts),
+                         {1: [(2, 1.0)], 2: [(3, 1.0)], 3: [(1, 1.0)]})
+
+    def test_counts_keep_notes(self):
+        self.assertEqual(tools.create_matrix_from_counts({}, [4]), {4: []})
+
+    def test_generate_from_matrix(self):
+        matrix = {1: [(2, 1.0)], 2: [(3, 1.0)], 3: [(1, 1.0)]}
+        self.assertEqual(list(tools.generate_from_matrix(matrix, 4, 1)),
+                         [2, 3, 1, 2])
+
+    def test_model_file(self):
+        matrix = tools.create_transition_matrix(MELODY + [(5,)])
+        expected = list(tools.generate_from_matrix(matrix, 50,
+                                                   rng=random.Random(1)))
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'melody.model')
+            TransitionModel.from_matrix(matrix).save(filename)
+            model = TransitionModel.load(filename)
+            try:
+                self.assertEqual(model.to_matrix().keys(), matrix.keys())
+                self.assertEqual(list(tools.generate_sequence(
+                                 model, 50, random.Random(1))), expected)
+            finally:
+                model.close()
         
 
+class TestProfiling(unittest.TestCase):
+
+    def test_stages(self):
+        tools.COMPILED_CACHE.clear()
+        profiling_toolkit.enable_profiling(trace_memory=False)
+        try:
+            list(tools.generate_sequence([1, 2, 3, 1, 3], 10))
+        finally:
+            profiling_toolkit.disable_profiling()
+        stages = profiling_toolkit.profiling_report()['stages']
+        self.assertEqual(stages['sampling']['notes'], 10)
+        self.assertEqual(stages['matrix_build']['calls'], 1)
+        self.assertEqual(stages['matrix_build']['notes'], 5)
+
+    def test_disabled(self):
+        profiling_toolkit.enable_profiling(trace_memory=False)
+        profiling_toolkit.disable_profiling()
+        list(tools.generate_sequence([1, 2, 3, 1, 3], 10))
+        self.assertEqual(profiling_toolkit.profiling_report()['stages'], {})
+
+    def test_midi_write(self):
+        profiling_toolkit.enable_profiling(trace_memory=False)
+        try:
+            midi_toolkit.write_midifile(io.BytesIO(), [[(60,), (62, 64)]],
+                                        fast=True)
+        finally:
+            profiling_toolkit.disable_profiling()
+        stages = profiling_toolkit.profiling_report()['stages']
+        self.assertEqual(stages['midi_write']['calls'], 1)
+        self.assertEqual(stages['midi_write']['notes'], 2)
+
+    def test_chord_update(self):
+        self.assertFalse(hasattr(tools.update_chord, '__wrapped__'))  # no per-note wrapper
+        profiling_toolkit.enable_profiling(trace_memory=False)
+        try:
+            sequence = sequences.create_chordseq(PRIME, 'Map10.txt', 2)
+        finally:
+            profiling_toolkit.disable_profiling()
+        stages = profiling_toolkit.profiling_report()['stages']
+        self.assertEqual(stages['chord_update']['notes'], len(sequence))
+        self.assertEqual(stages['chord_update']['calls'], 17)  # 9 sections, 8 transitions
+
+    def test_foreign_tracemalloc(self):
+        tracemalloc.start()
+        try:
+            profiling_toolkit.enable_profiling()
+            profiling_toolkit.disable_profiling()
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+
+class TestStreamSequence(unittest.TestCase):
+
+    def test_pipe(self):
+        read_end, write_end = os.pipe()
+        try:
+            stats = stream_sequence([(60,), (5,), (62, 65)], write_end,
+                                    tempo=4800)  # 240 ticks = 2.5ms
+            self.assertEqual(os.read(read_end, 1024), bytes(
+                             [0x90, 60, 64, 0x80, 60, 0, 0x90, 62, 64,
+                              0x90, 65, 64, 0x80, 62, 0, 0x80, 65, 0]))
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+        self.assertEqual(stats['events'], 3)
+
+    def test_stop_not_set(self):
+        stop = threading.Event()
+        with open(os.devnull, 'wb') as f:
+            stream_sequence([(60,), (62,)], f.fileno(), tempo=4800, stop=stop)
+            self.assertFalse(stop.is_set())
+            stats = stream_sequence([(60,), (62,)], f.fileno(), tempo=4800,
+                                    stop=stop)  # the event can be reused
+        self.assertEqual(stats['events'], 2)
+
+
+class TestIterTracks(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix='.mid')
+        os.close(handle)
+        midi_toolkit.write_midifile(self.filename, [[(60,), (62,), (64,)],
+                                                    [(48,), (50,)]], fast=True)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_tracks(self):
+        tables = list(midi_toolkit.iter_tracks(self.filename, tracks=1))
+        self.assertEqual([number for number, _ in tables], [1])
+        self.assertEqual(list(tables[0][1].melody()), [(48,), (50,)])
+        self.assertEqual(tables[0][1].onsets[0], 0)  # time restarts per track
+
+    def test_note_limit(self):
+        _, table = next(midi_toolkit.iter_tracks(self.filename, note_limit=2))
+        self.assertEqual(list(table.melody()), [(60,), (62,)])
+
+
+class TestCompiledCache(unittest.TestCase):
+
+    def test_equal_melodies(self):
+        tools.COMPILED_CACHE.clear()
+        sampler = tools.compile_melody([(60,), (62,), (60,)])
+        self.assertIs(tools.compile_melody([(60,), (62,), (60,)]), sampler)
+        self.assertEqual(tools.COMPILED_CACHE.hits, 1)
+        self.assertIsNot(tools.compile_melody([(60,), (62,), (62,)]), sampler)
+
+    def test_same_sequence(self):
+        melody = [1, 2, 3, 1, 3, 2, 2, 1]
+        first = list(tools.generate_sequence(melody, 30, random.Random(2)))
+        second = list(tools.generate_sequence(melody, 30, random.Random(2)))
+        self.assertEqual(first, second)
+
+
+class TestCompileMatrix(unittest.TestCase):
+
+    def test_tables(self):
+        matrix = {1: [(1, 0.5), (2, 0.5)], 2: [(1, 1.0)]}
+        self.assertEqual(tools.compile_matrix(matrix),
+                         {1: (1, (1, 2), (0.5, 1.0), (2,)),
+                          2: (2, (1,), (1.0,), (1,))})
+
+    def test_no_followers(self):
+        matrix = {1: [(2, 1.0)], 2: []}
+        sampler = tools.compile_matrix(matrix)
+        self.assertEqual(sampler[2], sampler[1])
+
+    def test_limit_rep(self):
+        sampler = tools.compile_matrix({1: [(1, 0.99), (2, 0.01)],
+                                        2: [(1, 1.0)]})
+        self.assertEqual(tools._choose_note_limit_rep(1, sampler, 2), (2, 0))
+
+    def test_empty_matrix(self):
+        self.assertEqual(tools.compile_matrix({}), {})
+
+
 MATRIX = {1: [(1, 1.0), (2, 1.0)],
           2: [(1, 1.0)]}
 
@@ -69,6 +263,11 @@ class TestGenerateSequence(unittest.TestCase):
         melody = tools.generate_sequence(1, 10)
         self.assertRaises(TypeError, list, melody)
 
+    def test_seeded_rng(self):
+        first = tools.generate_sequence(MELODY, 20, random.Random(7))
+        second = tools.generate_sequence(MELODY, 20, random.Random(7))
+        self.assertEqual(list(first), list(second))
+
 
 MAPPING = {'A': [1, 2], 'B': [3, 4], 'C': [5, 6]}
 
@@ -137,6 +336,25 @@ class TestConvertNote(unittest.TestCase):
         self.assertRaises(KeyError, tools.convert_note, 1, MAPPING, 'D')
 
 
+class TestTranslationTables(unittest.TestCase):
+
+    def test_tables(self):
+        self.assertEqual(tools.create_translation_tables(MAPPING),
+                         {'A': None, 'B': {1: 3, 2: 4}, 'C': {1: 5, 2: 6}})
+
+    def test_section_with_tables(self):
+        generator = (i for i in [1, 2, 1, 1, 2, 2, 1])
+        tables = tools.create_translation_tables(MAPPING)
+        section = tools.generate_section(generator, 7, MAPPING, 'B', tables)
+        self.assertEqual(list(section), [3, 4, 3, 3, 4, 4, 3])
+
+    def test_translate_a(self):
+        self.assertEqual(tools.translate_note(7, None), 7)
+
+    def test_wrong_note(self):
+        self.assertRaises(ValueError, tools.translate_note, 3, {1: 3, 2: 4})
+
+
 class TestUpdateChord(unittest.TestCase):
 
     def test_update(self):
@@ -166,6 +384,14 @@ class TestUpdateChord(unittest.TestCase):
         nset = [(1,), (2,), (3,), (4,)]
         self.assertEqual(tools.update_chord(nvalue, 1, nset, 0), (1,))
 
+    def test_compiled_set(self):
+        nset = tools.compile_note_set([(1,), (2,), (3,), (4,)])
+        self.assertEqual(tools.update_chord((1,), 1, nset, 4), (1, 2, 3, 4))
+
+    def test_masks(self):
+        self.assertEqual(tools.note_mask((1, 3)), 10)
+        self.assertEqual(tools.mask_to_notes(10), (1, 3))
+
 
 class TestFlattenSequence(unittest.TestCase):
 
@@ -255,6 +481,556 @@ class TestGroupInChunks(unittest.TestCase):
     def test_notiter(self):
         self.assertRaises(TypeError, tools.group_in_chunks, 1, 2)
 
+
+class TestSeededParts(unittest.TestCase):
+
+    def test_workers(self):
+        self.assertEqual(sequences.create_mapseq(PRIME, 'Map10.txt', 4,
+                                                 workers=1),
+                         sequences.create_mapseq(PRIME, 'Map10.txt', 4,
+                                                 workers=2))
+
+    def test_chord_workers(self):
+        self.assertEqual(sequences.create_chordseq(PRIME, 'Map10.txt', 2, 4,
+                                                   workers=1),
+                         sequences.create_chordseq(PRIME, 'Map10.txt', 2, 4,
+                                                   workers=2))
+
+
+@unittest.skipIf(array_toolkit is None, 'NumPy is not installed')
+class TestGenerateBatch(unittest.TestCase):
+
+    def test_seed(self):
+        self.assertEqual(array_toolkit.generate_sequences(PRIME, 50, 4, 7),
+                         array_toolkit.generate_sequences(PRIME, 50, 4, 7))
+
+    def test_limit_rep(self):
+        melody = [1, 1, 1, 1, 1, 1, 2, 1]
+        for sequence in array_toolkit.generate_sequences(melody, 200, 20, 1):
+            runs = [len(list(run)) for _, run in itertools.groupby(sequence)]
+            self.assertLessEqual(max(runs), 3)
+
+    def test_frequencies(self):
+        melody = [1, 2, 1, 3, 1, 2, 3, 1, 2, 1]
+        batch = array_toolkit.generate_sequences(melody, 100, 100, 3)
+        sequence = list(tools.generate_sequence(melody, 10000,
+                                                random.Random(3)))
+        batch_pairs = collections.Counter(
+            pair for row in batch for pair in zip(row, row[1:]))
+        pairs = collections.Counter(zip(sequence, sequence[1:]))
+        for pair in [(1, 2), (1, 3), (2, 1), (2, 3), (3, 1)]:
+            self.assertAlmostEqual(batch_pairs[pair] / sum(batch_pairs.values()),
+                                   pairs[pair] / sum(pairs.values()),
+                                   delta=0.03)
+
+
+class TestFastReader(unittest.TestCase):
+
+    def test_prime_files(self):
+        for number in range(1, 6):
+            filename = '{}Prime.mid'.format(number)
+            self.assertEqual(
+                list(midi_toolkit.parse_midifile(filename, True).iter_chords()),
+                list(midi_toolkit.parse_midifile(filename).iter_chords()))
+
+    def test_truncated(self):
+        with open('1Prime.mid', 'rb') as f:
+            data = f.read()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'truncated.mid')
+            for size in (6, 30, len(data) - 1):
+                with open(filename, 'wb') as f:
+                    f.write(data[:size])
+                for fast in (False, True):
+                    self.assertRaises(EOFError, midi_toolkit.parse_midifile,
+                                      filename, fast)
+
+    def test_not_midi(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'text.mid')
+            with open(filename, 'wb') as f:
+                f.write(b'not a midi file')
+            self.assertRaises(OSError, midi_toolkit.parse_midifile, filename,
+                              True)
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'melody.mid')
+        midi_toolkit.set_parse_cache(cache_dir=self.directory.name)
+
+    def tearDown(self):
+        midi_toolkit.set_parse_cache()
+        self.directory.cleanup()
+
+    def write(self, melody, mtime_ns):
+        midi_toolkit.write_midifile(self.filename, [melody], fast=True)
+        os.utime(self.filename, ns=(mtime_ns, mtime_ns))
+
+    def read(self):
+        midi_toolkit.PARSE_CACHE.clear()  # only the on-disk cache remains
+        return midi_toolkit.read_melody(self.filename, fast=True)[0]
+
+    def test_size_changed(self):
+        self.write([(60,), (62,)], 10 ** 18)
+        self.assertEqual(self.read(), [(60,), (62,)])
+        self.write([(60,), (62,), (64,)], 10 ** 18)
+        self.assertEqual(self.read(), [(60,), (62,), (64,)])
+
+    def test_mtime_changed(self):
+        self.write([(60,), (62,)], 10 ** 18)
+        self.assertEqual(self.read(), [(60,), (62,)])
+        self.write([(60,), (64,)], 10 ** 18 + 10 ** 9)  # same size
+        self.assertEqual(self.read(), [(60,), (64,)])
+
+    def test_bad_entry(self):
+        self.write([(60,), (62,)], 10 ** 18)
+        self.read()
+        for name in os.listdir(self.directory.name):
+            if name.endswith('.pickle'):
+                with open(os.path.join(self.directory.name, name), 'wb') as f:
+                    f.write(b'\x80\x04cno_such_module\nNoteTable\n.')
+        self.assertEqual(self.read(), [(60,), (62,)])
+
+
+class TestNoteOffs(unittest.TestCase):
+
+    def parse(self, events):
+        table = midi_toolkit.parse_track(midi_toolkit.NoteTable(480), events,
+                                         0)
+        return list(zip(table.pitches, table.onsets, table.offsets,
+                        table.channels))
+
+    def test_unmatched(self):
+        self.assertEqual(self.parse([(0, 'note_off', 60, 0, 0),
+                                     (0, 'note_on', 62, 64, 0),
+                                     (240, 'note_off', 62, 0, 0),
+                                     (0, 'note_on', 64, 0, 0)]),
+                         [(62, 0, 240, 0)])
+
+    def test_channel_and_pitch(self):
+        self.assertEqual(self.parse([(0, 'note_on', 60, 64, 0),
+                                     (0, 'note_on', 60, 64, 1),
+                                     (0, 'note_on', 64, 64, 0),
+                                     (120, 'note_off', 60, 0, 1),
+                                     (120, 'note_on', 60, 0, 0),
+                                     (120, 'note_off', 64, 0, 0)]),
+                         [(60, 0, 120, 1), (60, 0, 240, 0), (64, 0, 360, 0)])
+
+
+class TestChordGrouping(unittest.TestCase):
+
+    def test_chords_and_pauses(self):  # as read before NoteTable
+        handle, filename = tempfile.mkstemp(suffix='.mid')
+        os.close(handle)
+        try:
+            midi_toolkit.write_midifile(filename, [[(60, 64, 67), (5,), (62,),
+                                                    (5,), (5,), (60, 64),
+                                                    (65,)]], fast=True)
+            self.assertEqual(midi_toolkit.read_midifile(filename),
+                             [[((60, 64, 67), (120,)), ((5,), (120,)),
+                               ((62,), (120,)), ((5,), (120,)), ((5,), (120,)),
+                               ((60, 64), (120,)), ((65,), (120,))]])
+        finally:
+            os.remove(filename)
+
+    def test_pause_beside_note(self):  # same onset and offset, never grouped
+        table = midi_toolkit.parse_track(midi_toolkit.NoteTable(480),
+                                         [(0, 'note_on', 60, 64, 0),
+                                          (240, 'note_on', 62, 64, 0),
+                                          (0, 'note_off', 60, 0, 0),
+                                          (0, 'note_on', 64, 64, 0),
+                                          (240, 'note_off', 62, 0, 0),
+                                          (0, 'note_off', 64, 0, 0)], 0)
+        self.assertEqual(list(table.iter_chords()),
+                         [((5,), (120,)), ((60,), (120,)),
+                          ((62, 64), (120,))])
+
+
+class TestMapFile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with open('Map10.txt') as f:
+            self.lines = f.read().splitlines()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, lines, name='map.txt'):
+        filename = os.path.join(self.directory.name, name)
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines))
+        return filename
+
+    def replace(self, field, line):
+        return [line if old.startswith(field + ' =') else old
+                for old in self.lines]
+
+    def test_code_rejected(self):
+        filename = self.write(self.replace('mapping',
+                                           "mapping = __import__('os')"))
+        self.assertRaises(ValueError, mapping_toolkit.read_map_file, filename)
+
+    def test_fields(self):
+        for lines in (self.lines + ['tempo = 120'],
+                      self.lines + ['total_length = 208'],
+                      [line for line in self.lines
+                       if not line.startswith('sections')]):
+            self.assertRaises(ValueError, mapping_toolkit.read_map_file,
+                              self.write(lines))
+
+    def test_note_range(self):
+        filename = self.write(self.replace('mapping', "mapping = {'A': "
+                                           "[(71,), (200,)], 'B': [(73,), "
+                                           "(61,)], 'C': [(1,), (2,)], 'D': "
+                                           "[(3,), (4,)]}"))
+        self.assertRaises(TypeError, mapping_toolkit.read_map_file, filename)
+
+    def test_compiled_map(self):
+        filename = os.path.join(self.directory.name, 'map.json')
+        mapping_toolkit.Map.from_map_file('Map10.txt').write_compiled_map(
+            filename)
+        self.assertEqual(mapping_toolkit.read_map_file(filename),
+                         mapping_toolkit.read_map_file('Map10.txt'))
+
+    def test_cached_copies(self):
+        first = mapping_toolkit.Map.from_map_file('Map10.txt')
+        first.mapping['A'].append((60,))
+        first.sections[0] = 0
+        second = mapping_toolkit.Map.from_map_file('Map10.txt')
+        self.assertEqual(len(second.mapping['A']), 7)
+        self.assertEqual(second.sections[0], 16)
+
+
+class TestCorpus(unittest.TestCase):
+
+    def test_corrupt_files(self):
+        with open('1Prime.mid', 'rb') as f:
+            data = f.read()
+        with tempfile.TemporaryDirectory() as directory:
+            for name, content in (('a.mid', data), ('b.mid', b'MThd\x00\x00'),
+                                  ('c.mid', data[:100]), ('d.txt', b'')):
+                with open(os.path.join(directory, name), 'wb') as f:
+                    f.write(content)
+            matrix, read, skipped = corpus_toolkit.train_corpus(directory,
+                                                                workers=1)
+        self.assertEqual((read, skipped), (1, 2))
+        self.assertEqual(matrix, tools.create_transition_matrix(PRIME))
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = server.GenerationServer(workers=1)  # serves this directory
+
+    def tearDown(self):
+        self.server.close()
+
+    def route(self, *requests):
+        async def send():
+            return await asyncio.gather(*(self.server.route(method, path,
+                                                            body)
+                                          for method, path, body in requests))
+        return asyncio.run(send())
+
+    def generate(self, job):
+        return ('POST', '/generate', json.dumps(job).encode())
+
+    def test_generate(self):
+        job = {'type': 'basic', 'source': '1Prime.mid', 'length': 16}
+        first, second = self.route(self.generate(dict(job, seed=1)),
+                                   self.generate(dict(job, seed=2)))
+        self.assertEqual((first[0], second[0]), (200, 200))
+        self.assertTrue(first[2].startswith(b'MThd'))
+        status, _, content = self.route(('GET', '/stats', b''))[0]
+        stats = json.loads(content)
+        self.assertEqual((stats['generated'], stats['groups'],
+                          stats['grouped_jobs']), (2, 1, 2))
+
+    def test_bad_requests(self):
+        for job in ({'type': 'basic', 'source': '1Prime.mid'},  # no length
+                    {'type': 'basic', 'source': '../1Prime.mid', 'length': 4},
+                    {'type': 'basic', 'source': '/etc/passwd', 'length': 4}):
+            status, _, _ = self.route(self.generate(job))[0]
+            self.assertEqual(status, 400)
+        self.assertEqual(self.route(('POST', '/generate', b'{'))[0][0], 400)
+
+
+class TestIterSequences(unittest.TestCase):  # outputs of the list-building create_* functions
+
+    def test_sparse(self):
+        self.assertEqual(list(sequences.iter_sparseseq(PRIME, 12, False,
+                                                       random.Random(5))),
+                         [(5,), (5,), (5,), (5,), (5,), (5,), (74,), (66,),
+                          (68,), (5,), (69,), (71,)])
+        self.assertEqual(list(sequences.iter_sparseseq(PRIME, 12, True,
+                                                       random.Random(5))),
+                         [(71,), (5,), (74,), (66,), (5,), (5,), (5,), (69,),
+                          (66,), (5,), (68,), (5,)])
+
+    def test_mapped(self):
+        random.seed(8)
+        sequence = list(sequences.iter_mapseq(PRIME, 'Map10.txt'))
+        self.assertEqual(len(sequence), 208)
+        self.assertEqual(sequence[:10], [(68,), (69,), (66,), (68,), (69,),
+                                         (71,), (74,), (66,), (68,), (69,)])
+
+    def test_chorded(self):
+        random.seed(8)
+        sequence = list(sequences.iter_chordseq(PRIME, 'Map10.txt', 2))
+        self.assertEqual(len(sequence), 208)
+        self.assertEqual(sequence[-4:], [(74, 66, 68), (73, 68, 74),
+                                         (76, 66, 73), (66, 68, 71)])
+
+    def test_part_order(self):
+        info = mapping_toolkit.Map.from_map_file('Map10.txt')
+        parts = [note for part in sequences.split_map(info)
+                 for note in sequences.generate_part(PRIME, info, part, 3)]
+        self.assertEqual(list(sequences.iter_parts(PRIME, info, 3, workers=2)),
+                         parts)
+
+
+class TestBuildMapping(unittest.TestCase):
+
+    files = ['1Prime.mid', '2Prime.mid', '3Prime.mid', '4Prime.mid',
+             '5Prime.mid']
+    mapping = {'A': [(71,), (66,), (74,), (73,), (76,), (68,), (69,)],
+               'B': [(73,), (61,), (81,), (80,), (83,), (74,), (76,)],
+               'C': [(66,), (61,), (74,), (68,), (73,), (64,), (62,)],
+               'D': [(68,), (63,), (73,), (66,), (78,), (76,), (71,)],
+               'E': [(70,), (63,), (73,), (68,), (58,), (78,), (71,)]}  # before the pool
+
+    def test_serial(self):
+        self.assertEqual(mapping_toolkit.build_mapping(self.files, workers=1),
+                         self.mapping)
+
+    def test_cached(self):
+        cache = midi_toolkit.PARSE_CACHE
+        cache.clear()
+        mapping_toolkit.build_mapping(self.files[:2])  # small files, no pool
+        hits, misses = cache.hits, cache.misses
+        self.assertEqual(mapping_toolkit.build_mapping(self.files[:2]),
+                         {'A': self.mapping['A'], 'B': self.mapping['B']})
+        self.assertEqual(cache.hits, hits + 2)
+        self.assertEqual(cache.misses, misses)
+        self.assertIs(midi_toolkit.read_note_table('1Prime.mid', True, 0),
+                      next(midi_toolkit.iter_tracks('1Prime.mid'))[1])
+
+    def test_pool(self):
+        self.assertEqual(mapping_toolkit.build_mapping(self.files, workers=2),
+                         self.mapping)
+
+
+class MaskRandom(object):  # replays a mask as the draws of generate_transition
+
+    def __init__(self, mask):
+        self.draws = iter(mask)
+
+    def random(self):
+        return 0.0 if next(self.draws) else 1.0
+
+
+@unittest.skipIf(array_toolkit is None, 'NumPy is not installed')
+class TestSparseBatch(unittest.TestCase):
+
+    def test_seed(self):
+        self.assertEqual(array_toolkit.draw_mask(50, count=4, rng=7).tolist(),
+                         array_toolkit.draw_mask(50, count=4, rng=7).tolist())
+        self.assertEqual(
+            array_toolkit.generate_sparse_sequences(PRIME, 50, 4, seed=7),
+            array_toolkit.generate_sparse_sequences(PRIME, 50, 4, seed=7))
+
+    def test_ramp(self):
+        mask = array_toolkit.draw_mask(10, 'fade', count=4000, rng=2)
+        for i, kept in enumerate(mask.mean(axis=0)):
+            self.assertAlmostEqual(kept, 1 - i / 10.0, delta=0.03)
+
+    def test_sparse_mask(self):
+        codes = array_toolkit.np.arange(40).reshape(2, 20)
+        mask = array_toolkit.draw_mask(20, count=2, rng=4)
+        batch = array_toolkit.apply_sparse_mask(codes, mask, -1)
+        for row, keep, sequence in zip(codes.tolist(), mask.tolist(),
+                                       batch.tolist()):
+            notes = iter(row)  # as in the loop of iter_sparseseq
+            self.assertEqual(sequence,
+                             [next(notes) if kept else -1 for kept in keep])
+
+    def test_transition(self):
+        mapping = mapping_toolkit.Map.from_map_file('Map10.txt').mapping
+        sequence = list(tools.generate_sequence(PRIME, 30, random.Random(1)))
+        mask = array_toolkit.draw_mask(30, rng=5)
+        transition = array_toolkit.create_transition(sequence, mapping, 'B',
+                                                     'C', rng=5)
+        self.assertEqual(transition,
+                         list(tools.generate_transition(iter(sequence), 30,
+                                                        mapping, 'B', 'C',
+                                                        rng=MaskRandom(mask))))
+
+
+class TestFastWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def tracks(self):
+        timed = NoteSequence([(60, 64, 67), (5,), (62,), (65, 69)],
+                             [240, 480, 20000, 120])  # 20000 takes three bytes
+        return [timed, [(60,), (5,), (64, 67), (72,)]]
+
+    def write(self, fast):
+        filename = os.path.join(self.directory.name,
+                                'fast.mid' if fast else 'mido.mid')
+        midi_toolkit.write_midifile(filename, self.tracks(), fast=fast)
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_same_bytes(self):
+        self.assertEqual(self.write(True), self.write(False))
+
+    def test_file_object(self):
+        outfile = io.BytesIO()
+        midi_toolkit.write_midifile(outfile, self.tracks(), fast=True)
+        self.assertEqual(outfile.getvalue(), self.write(False))
+
+
+class TestNoteSequence(unittest.TestCase):
+
+    chords = [(60, 64, 67), (5,), (62,), (65, 69), (71,), (72, 76)]
+    durations = [240, 480, 120, 20000, 240, 960]
+
+    def setUp(self):
+        self.sequence = NoteSequence(self.chords, self.durations)
+
+    def test_view(self):
+        view = self.sequence[1:5]
+        self.assertIs(view.pitches, self.sequence.pitches)
+        self.assertEqual(view, self.chords[1:5])
+        self.assertEqual(view[1:], self.chords[2:5])
+        self.assertEqual(view[-1], (71,))
+        self.assertEqual(len(view[2:2]), 0)
+        self.assertRaises(IndexError, view.__getitem__, 4)
+
+    def test_slices(self):
+        self.assertEqual(self.sequence[-3:-1], self.chords[-3:-1])
+        self.assertEqual(self.sequence[4:1], [])
+        self.assertEqual(self.sequence[::2], self.chords[::2])
+        self.assertEqual(self.sequence[1:5][::-1], self.chords[1:5][::-1])
+        self.assertEqual(list(self.sequence[::-2].timed()),
+                         list(zip(self.chords, self.durations))[::-2])
+
+    def test_append_view(self):
+        view = self.sequence[:2]
+        self.assertRaises(ValueError, view.append, (60,), 240)
+        self.sequence.append((60,), 240)
+        self.assertEqual(len(view), 2)
+
+    def test_timed_view(self):
+        self.assertEqual(list(self.sequence[2:4].timed()),
+                         [((62,), 120), ((65, 69), 20000)])
+
+    def test_from_pairs(self):
+        pairs = [((60, 64), (240,)), ((5,), 480)]
+        sequence = NoteSequence.from_pairs(pairs)
+        self.assertEqual(list(sequence.timed()),
+                         [((60, 64), 240), ((5,), 480)])
+
+    def test_equality(self):
+        self.assertEqual(self.sequence, list(self.chords))
+        self.assertEqual(self.sequence, tuple(self.chords))
+        self.assertNotEqual(self.sequence, self.chords[:-1])
+        self.assertNotEqual(self.sequence, self.chords[:-1] + [(60,)])
+        self.assertNotEqual(self.sequence, 'sequence')
+
+    def test_write_durations(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'timed.mid')
+            for fast in (False, True):
+                midi_toolkit.write_midifile(filename, [self.sequence[1:]],
+                                            fast=fast)
+                self.assertEqual(
+                    list(midi_toolkit.parse_midifile(filename).iter_chords()),
+                    [(chord, (duration // 2,))  # scaled to 240 ticks per beat
+                     for chord, duration in zip(self.chords[1:],
+                                                self.durations[1:])])
+
+
+class TestBatch(unittest.TestCase):
+
+    jobs = {'basic': {'length': 20}, 'mapped': {'map': 'Map10.txt'},
+            'sparse': {'length': 20}, 'chord': {'map': 'Map10.txt',
+                                                'increase': 2},
+            'grouped': {'length': 5}}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def job(self, job_type, name, **keys):
+        job = dict(self.jobs[job_type], type=job_type, source='1Prime.mid',
+                   output=os.path.join(self.directory.name, name))
+        job.update(keys)
+        return job
+
+    def test_invalid_line(self):
+        manifest = os.path.join(self.directory.name, 'manifest.jsonl')
+        with open(manifest, 'w') as f:
+            f.write(json.dumps(self.job('basic', 'a.mid')) + '\n\n')
+            f.write('{"type": "basic", "source": \n')
+        self.assertRaisesRegex(ValueError, 'line 3', batch.read_manifest,
+                               manifest)
+
+    def test_missing_keys(self):
+        for job_type in self.jobs:
+            job = self.job(job_type, 'a.mid')
+            self.assertEqual(batch.check_job(job, 1)['id'], 1)
+            for key in ('source', 'output') + batch.REQUIRED_KEYS[job_type]:
+                incomplete = dict(job)
+                del incomplete[key]
+                self.assertRaisesRegex(ValueError, 'missing {}'.format(key),
+                                       batch.check_job, incomplete, 1)
+
+    def test_segments(self):
+        job = self.job('grouped', 'a.mid', grouping='segments')
+        self.assertRaisesRegex(ValueError, 'missing segment_size',
+                               batch.check_job, job, 1)
+        job['segment_size'] = 3
+        self.assertEqual(batch.check_job(job, 1)['type'], 'grouped')
+
+    def test_failed_job(self):
+        jobs = [batch.check_job(self.job('basic', 'a.mid',
+                                         source='missing.mid'), 1),
+                batch.check_job(self.job('basic', 'b.mid'), 2)]
+        reports = list(batch.run_batch(jobs, workers=1))
+        self.assertEqual([report['status'] for report in reports],
+                         ['error', 'ok'])
+        self.assertIn('error', reports[0])
+        self.assertEqual(reports[1]['notes'], 20)
+        self.assertTrue(os.path.exists(jobs[1]['output']))
+
+    def test_workers(self):
+        outputs = []
+        for workers in (1, 2):
+            jobs = [batch.check_job(self.job(job_type, '{}{}.mid'.format(
+                                             job_type, workers), seed=7), 1)
+                    for job_type in ('mapped', 'chord')]
+            reports = list(batch.run_batch(jobs, workers))
+            self.assertEqual([report['status'] for report in reports],
+                             ['ok', 'ok'])
+            contents = []
+            for job in jobs:
+                with open(job['output'], 'rb') as f:
+                    contents.append(f.read())
+            outputs.append(contents)
+        self.assertEqual(outputs[0], outputs[1])
+
         
 if __name__=='__main__':
     unittest.main()
@@ -5,20 +5,25 @@ import os
 import argparse
 
 from midi_toolkit import read_melody, write_midifile
-from sequences import create_mapseq, create_sparseseq, create_chordseq
+from sequences import iter_mapseq, iter_sparseseq, iter_chordseq
 import sequence_toolkit as tools
+from profiling_toolkit import enable_profiling, write_profiling_report
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument('type', help=' '.join(('1 : Basic Sequence,',
-                                      '2 : Mapped Sequence,',
-                                      '3 : Sparse Sequence,',
-                                      '4 : Chord Sequence,',
-                                      '5 : Grouped Sequence,')))
-parser.add_argument('midi_file', help='Name of origin midi file.')
-parser.add_argument('output_file', help='Name of output midi file.')
-
-ARGS = parser.parse_args()
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('type', help=' '.join(('1 : Basic Sequence,',
+                                          '2 : Mapped Sequence,',
+                                          '3 : Sparse Sequence,',
+                                          '4 : Chord Sequence,',
+                                          '5 : Grouped Sequence,')))
+    parser.add_argument('midi_file', help='Name of origin midi file.')
+    parser.add_argument('output_file', help='Name of output midi file.')
+    parser.add_argument('--profile', nargs='?', const='-', metavar='REPORT',
+                        help='Write a JSON report of the time, calls, notes '
+                             'and memory of each stage to REPORT (default: '
+                             'stdout).')
+    return parser.parse_args(args)
 
 
 def get_map():
@@ -42,12 +47,12 @@ def get_map():
 
 def write_seq(melody):
     length = str(input('Sequence length (in notes): '))
-    return list(tools.generate_sequence(melody, int(length)))
+    return tools.generate_sequence(melody, int(length))
 
 
 def write_mapseq(melody):
     map_file = get_map()
-    return create_mapseq(melody, map_file)
+    return iter_mapseq(melody, map_file)
 
 
 def write_sparseseq(melody):
@@ -55,13 +60,13 @@ def write_sparseseq(melody):
     from_user = str(input('''Do you want the sequence to emerge from silence 
                       or to fade away? 1|2: '''))
     fading = False if from_user == '1' else True
-    return list(create_sparseseq(melody, int(length), fading))
+    return iter_sparseseq(melody, int(length), fading)
 
 
 def write_chordseq(melody):
     map_file = get_map()
     increase = str(input('Chord Increase: '))
-    return create_chordseq(melody, map_file, int(increase))
+    return iter_chordseq(melody, map_file, int(increase))
 
 
 def write_groupseq(melody):
@@ -83,15 +88,22 @@ functions = {'1': write_seq, '2': write_mapseq, '3': write_sparseseq,
              '4': write_chordseq, '5': write_groupseq}
 
 
-def main():
-    melody = read_melody(ARGS.midi_file)
-    sequence = functions.get(ARGS.type)
+def main(args=None):
+    args = parse_args(args)
+    if args.profile:
+        enable_profiling()
+    tracks = read_melody(args.midi_file)
+    sequence = functions.get(args.type)
     if sequence:
-        seq = sequence(melody)
+        seq = [sequence(melody) for melody in tracks]
     else:
         print('Invalid Sequence Type. Must be 1 , 2, 3, 4 or 5. Look at Help.')
         raise SystemExit
-    output_name = ARGS.output_file
-    write_midifile(output_name, seq)
+    output_name = args.output_file
+    write_midifile(output_name, seq, fast=True)
+    if args.profile:
+        write_profiling_report(args.profile)
+
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+'''Contains the per stage instrumentation of the program (midi parse,
+chord grouping, matrix build, sampling, section conversion, chord updates
+and midi write). For each stage it records wall time, number of calls,
+notes processed and net memory growth (the traced memory still held when
+each call ends, not the total allocated). It is off by default. While
+off, a decorated function still costs a flag check and an extra call
+frame per call, so per-note work (chord updates) is recorded around its
+loop with profiled_map instead. Times are inclusive: a stage that runs
+inside another (e.g. matrix build within sampling) is counted in both.'''
+
+import json
+import time
+import functools
+import tracemalloc
+
+
+ENABLED = False
+STAGES = {}  # stage name -> StageRecord
+STARTED_TRACING = False  # tracemalloc was started by enable_profiling
+
+
+class StageRecord(object):
+
+    '''Measures accumulated by one stage.'''
+
+    __slots__ = ('seconds', 'calls', 'notes', 'memory_growth_bytes')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.notes = 0
+        self.memory_growth_bytes = 0  # summed over calls, each at least 0
+
+    def as_dict(self):
+        return {'seconds': self.seconds, 'calls': self.calls,
+                'notes': self.notes,
+                'memory_growth_bytes': self.memory_growth_bytes}
+
+
+def enable_profiling(trace_memory=True):
+
+    '''Starts recording, clearing previous records. With trace_memory,
+    allocations are traced with tracemalloc (slower, but gives the
+    memory growth of each stage).'''
+
+    global ENABLED, STARTED_TRACING
+    STAGES.clear()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        STARTED_TRACING = True
+    ENABLED = True
+
+
+def disable_profiling():
+
+    '''Stops recording. Records are kept until the next enable_profiling.
+    tracemalloc is stopped only if enable_profiling started it.'''
+
+    global ENABLED, STARTED_TRACING
+    ENABLED = False
+    if STARTED_TRACING:
+        tracemalloc.stop()
+        STARTED_TRACING = False
+
+
+def get_record(stage):
+    record = STAGES.get(stage)
+    if record is None:
+        record = STAGES[stage] = StageRecord()
+    return record
+
+
+def _traced_memory():
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+
+def profiled(stage, count_notes=None, count_input=None, counted=True):
+
+    '''Decorator recording each call of a function under a stage. If
+    given, count_notes takes the function's result, or count_input its
+    first argument, and returns the number of notes processed; otherwise
+    each call counts as one note. With counted = False calls add no
+    notes (e.g. when the notes are counted by count_items).'''
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            record = get_record(stage)
+            memory = _traced_memory()
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            record.seconds += time.perf_counter() - start
+            record.memory_growth_bytes += max(0, _traced_memory() - memory)
+            record.calls += 1
+            if not counted:
+                pass
+            elif count_input:
+                record.notes += count_input(args[0])
+            elif count_notes:
+                record.notes += count_notes(result)
+            else:
+                record.notes += 1
+            return result
+        return wrapper
+    return decorator
+
+
+def profiled_generator(stage):
+
+    '''Decorator recording a generator function under a stage. Time and
+    memory are measured within each step of the generator, so time spent
+    by its consumer is not counted, and each item yielded counts as a
+    note.'''
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            return _profile_generator(get_record(stage),
+                                      function(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def _profile_generator(record, generator):
+    record.calls += 1
+    while True:
+        memory = _traced_memory()
+        start = time.perf_counter()
+        try:
+            item = next(generator)
+        except StopIteration:
+            return
+        finally:
+            record.seconds += time.perf_counter() - start
+            record.memory_growth_bytes += max(0, _traced_memory() - memory)
+        record.notes += 1
+        yield item
+
+
+def profiled_map(stage, function, *iterables):
+
+    '''Like map, recording each call of function under a stage (one
+    note per call, one stage call per map). Only the calls are measured,
+    not the production of their arguments. While profiling is off this
+    is map itself, so per-note functions pay nothing.'''
+
+    if not ENABLED:
+        return map(function, *iterables)
+    return _profile_calls(get_record(stage), function, zip(*iterables))
+
+
+def _profile_calls(record, function, arguments):
+    record.calls += 1
+    for args in arguments:
+        memory = _traced_memory()
+        start = time.perf_counter()
+        result = function(*args)
+        record.seconds += time.perf_counter() - start
+        record.memory_growth_bytes += max(0, _traced_memory() - memory)
+        record.notes += 1
+        yield result
+
+
+def count_items(stage, items):
+
+    '''Yields the items of an iterable, adding each one to the notes of
+    a stage (e.g. notes consumed by a writer).'''
+
+    record = get_record(stage)
+    for item in items:
+        record.notes += 1
+        yield item
+
+
+def profiling_report():
+
+    '''Returns the records of all stages as a dictionary.'''
+
+    return {'stages': {stage: record.as_dict()
+                       for stage, record in sorted(STAGES.items())},
+            'memory_traced': tracemalloc.is_tracing()}
+
+
+def write_profiling_report(filename='-'):
+
+    '''Writes profiling_report as JSON to a file, or to stdout for "-".'''
+
+    report = json.dumps(profiling_report(), indent=1)
+    if filename == '-':
+        print(report)
+    else:
+        with open(filename, 'w') as f:
+            f.write(report + '\n')
@@ -1,32 +1,109 @@
 '''Collection of component functions needed to build the various sequences.'''
 
+import io
+import pickle
 import random
+import bisect
+import hashlib
+import itertools
 import collections
 
+from cache_toolkit import LRUCache
+from profiling_toolkit import profiled, profiled_generator, profiled_map
 
-def generate_sequence(melody, length):
+
+def generate_sequence(melody, length, rng=random):
     
     '''Builds a note sequence based on the transition probabilities 
-    of a melody. Takes a melody and length (in notes) as input. Output
+    of a melody. Takes a melody (or a model with a generate method,
+    such as a TransitionModel, see model_toolkit.py) and length (in
+    notes) as input, plus an optional random number generator (e.g. a
+    seeded random.Random, defaults to the random module). Output is a
+    generator.'''
+
+    if hasattr(melody, 'generate'):  # e.g. a TransitionModel
+        yield from melody.generate(length, rng=rng)
+        return
+    note = rng.choice(melody)
+    yield from sample_sequence(compile_melody(melody), length, note, rng)
+
+
+def generate_from_matrix(matrix, length, note=None, rng=random):
+
+    '''Builds a note sequence from a transition matrix (e.g. one
+    trained on a corpus, see corpus_toolkit.py). Takes a matrix,
+    length (in notes), an optional first note (a random note of the
+    matrix by default) and random number generator. Output is a
+    generator.'''
+
+    if note is None:
+        note = rng.choice(list(matrix))
+    yield from sample_sequence(compile_matrix(matrix), length, note, rng)
+
+
+@profiled_generator('sampling')
+def sample_sequence(sampler, length, note, rng=random):
+
+    '''Component of generate_sequence. Draws *length* notes from a
+    compiled matrix (see compile_matrix), starting from *note*. Output
     is a generator.'''
 
-    note = random.choice(melody)
-    matrix = create_transition_matrix(melody)
-    if len(set(melody)) == 1:  # the sequence is composed of one note on repeat
+    if len(sampler) == 1:  # the sequence is composed of one note on repeat
         for i in range(length):
-            if not matrix[note]: # fix for notes with no followers
-                note = max(matrix, key=lambda x: len(matrix[x]))
-            note = _choose_note_ignore_rep(note, matrix)
+            note = _choose_note_ignore_rep(note, sampler, rng)
             yield note
     else:
         repetitions = 0
         for i in range(length):
-            if not matrix[note]:  # fix for notes with no followers
-                note = max(matrix, key=lambda x: len(matrix[x]))
-            note, repetitions = _choose_note_limit_rep(note, matrix, repetitions)
+            note, repetitions = _choose_note_limit_rep(note, sampler, repetitions,
+                                                       rng)
             yield note
 
 
+def compile_melody(melody):
+
+    '''Component of generate_sequence. Returns the compiled transition
+    matrix of a melody (see compile_matrix). Compiled matrices are kept
+    in COMPILED_CACHE, keyed by the content of their melody, so that
+    building many sequences from the same melody (e.g. the sections of
+    a mapped sequence) compiles it once.'''
+
+    key = melody_key(melody)
+    sampler = COMPILED_CACHE.get(key)
+    if sampler is None:
+        sampler = compile_matrix(create_transition_matrix(melody))
+        COMPILED_CACHE.put(key, sampler)
+    return sampler
+
+
+def melody_key(melody):
+
+    '''Component of compile_melody. Returns a hash of the content of a
+    melody, equal for equal melodies.'''
+
+    if not isinstance(melody, (list, tuple, str)):
+        melody = list(melody)
+    data = io.BytesIO()
+    pickler = pickle.Pickler(data, 4)
+    pickler.fast = True  # no memo, so that shared and equal tuples give the same bytes
+    pickler.dump(melody)
+    return hashlib.blake2b(data.getvalue(), digest_size=16).digest()
+
+
+def compiled_size(sampler):
+
+    '''Component of compile_melody. Returns the number of notes and
+    transitions of a compiled matrix, which bounds COMPILED_CACHE.'''
+
+    return len(sampler) + sum(len(options) for _, options, _, _ in
+                              sampler.values())
+
+
+COMPILED_CACHE = LRUCache(maxsize=1 << 21,  # notes and transitions in total
+                          weigh=compiled_size)  # keyed by melody_key
+
+
+@profiled('matrix_build', count_input=len)
 def create_transition_matrix(melody):
     
     '''Component of generate_sequence. Takes a sequence and calculates
@@ -36,76 +113,126 @@ def create_transition_matrix(melody):
     E.g. INPUT:[1, 2, 3, 1, 3]; 
     OUTPUT: {1: [(2, .5), (3, 0.5)], 2: [(3, 1.0)], 3: [(1, 1.0)]}.'''
     
+    return create_matrix_from_counts(count_transitions(melody), melody)
+
+
+def count_transitions(melody):
+
+    '''Component of create_transition_matrix. Counts how often each
+    item of a sequence is followed by each other item. Output is a
+    collections.Counter of (item, next item) pairs, which can be added
+    to the counts of other sequences.'''
+
+    return collections.Counter(zip(melody[:-1], melody[1:]))  # pairs adjacent notes and counts how often that pair exists in the sequence
+
+
+def create_matrix_from_counts(pair_counter, notes=()):
+
+    '''Component of create_transition_matrix. Takes the pair counts
+    of one or more sequences (see count_transitions), plus optional
+    items to include even if they are never followed by anything, and
+    turns them into probabilities. Output is a transition matrix.'''
+
+    followers = {note: [] for note in notes}
+    for (note, next_note), count in pair_counter.items():
+        followers.setdefault(note, []).append((next_note, count))  # buckets the pairs by their first note
+        followers.setdefault(next_note, [])
     matrix = {}
-    pair_counter = collections.Counter(zip(melody[:-1], melody[1:]))  # pairs adjacent notes and counts how often that pair exists in the sequence
-    for note in set(melody):
-        subset = sorted(item for item in pair_counter.items()
-                        if item[0][0] == note)  # extracts the pairs in which the first note is the one were currently observing
-        options = [pair[1] for pair, count in subset]  # extracts the second notes of each pair
-        total_count = sum(count for pair, count in subset)  
-        probs = [count / float(total_count) for pair, count in subset]
-        matrix[note] = list(zip(options, probs))  # list because repr of zip objects in Py3
+    for note, subset in followers.items():
+        subset.sort()
+        total_count = sum(count for next_note, count in subset)
+        matrix[note] = [(next_note, count / float(total_count))
+                        for next_note, count in subset]
     return matrix
 
 
-def _choose_note_ignore_rep(note, matrix):
+def compile_matrix(matrix):
+
+    '''Component of generate_sequence. Takes a transition matrix and
+    precomputes everything needed to draw the next note: the possible
+    notes, their cumulative probabilities (searched with bisect) and the
+    notes other than the current one (used to break repetitions). Notes
+    with no followers borrow the tables of the note with most followers.
+    Output is a dictionary where keys are notes and values are
+    (source note, options, cumulative probabilities, no repetitions)
+    tuples.'''
+
+    sampler = {}
+    for note, transitions in matrix.items():
+        options = tuple(possible_note for possible_note, _ in transitions)
+        cumulative = tuple(itertools.accumulate(
+                            probability for _, probability in transitions))
+        no_rep = tuple(option for option in options if option != note)
+        sampler[note] = (note, options, cumulative, no_rep)
+    if matrix:
+        fallback = sampler[max(matrix, key=lambda x: len(matrix[x]))]
+        for note, transitions in matrix.items():
+            if not transitions:  # fix for notes with no followers
+                sampler[note] = fallback
+    return sampler
+
+
+def _choose_note_ignore_rep(note, sampler, rng=random):
     
     '''Component of generate_sequence. Chooses the next note
     in the sequence based on the current one, does not take
     repetitions into account.'''
-    rand = random.random()
-    current_prob = 0.0  
-    for possible_note, probability in matrix[note]:
-        current_prob += probability
-        if rand < current_prob:
-            return possible_note
+
+    _, options, cumulative, _ = sampler[note]
+    rand = rng.random() * cumulative[-1]  # guards against rounding
+    return options[bisect.bisect_right(cumulative, rand)]
     
 
-def _choose_note_limit_rep(note, matrix, repetitions):
+def _choose_note_limit_rep(note, sampler, repetitions, rng=random):
 
     '''Component of generate_sequence. Chooses the next note
     in the sequence based on the current one, but keeps track
     of repetitions, avoiding notes that have been already selected
     three times in a row. Output is a tuple (note, repetitions).'''
     
-    new_note = random.choice([n[0] for n in matrix[note] if n[0] != note])
-    if repetitions == 2: # check if *note* appeared three times in a row
-        return new_note, 0
-    rand = random.random()
-    current_prob = 0.0  
-    for possible_note, probability in matrix[note]:
-        current_prob += probability
-        if rand < current_prob:
-            if possible_note == note:  # repetition
-                return possible_note, repetitions + 1
-            else:
-                return possible_note, 0
+    note, options, cumulative, no_rep = sampler[note]
+    if repetitions == 2 and no_rep: # check if *note* appeared three times in a row
+        return rng.choice(no_rep), 0
+    rand = rng.random() * cumulative[-1]  # guards against rounding
+    possible_note = options[bisect.bisect_right(cumulative, rand)]
+    if possible_note == note:  # repetition
+        return possible_note, repetitions + 1
+    return possible_note, 0
 
 
-def generate_section(generator, length, mapping, section):
+@profiled_generator('section_conversion')
+def generate_section(generator, length, mapping, section, tables=None):
     
     '''Builds a section for mapped and chorded sequences.
     Takes a sequence generator, length (in notes) and a
-    mapping dictionary (section to notes) as input. Output
-    is a generator.'''
+    mapping dictionary (section to notes) as input, plus the
+    optional translation tables of the mapping (see
+    create_translation_tables). Output is a generator.'''
 
+    table = get_translation_table(mapping, section, tables)
     for _ in range(length):
         note = next(generator)
-        yield convert_note(note, mapping, section)
+        yield translate_note(note, table)
 
 
-def generate_transition(generator, length, mapping, section, next_section):
+@profiled_generator('section_conversion')
+def generate_transition(generator, length, mapping, section, next_section,
+                        tables=None, rng=random):
     
     '''Builds a gradual transition between two sections. Takes a
     sequence generator, length (in notes) as input and a mapping
-    dictionary (section to notes) as input. Output is a generator.'''
+    dictionary (section to notes) as input, plus the optional
+    translation tables of the mapping and random number generator.
+    Output is a generator.'''
     
+    table = get_translation_table(mapping, section, tables)
+    next_table = get_translation_table(mapping, next_section, tables)
     for i in range(length):
         note = next(generator)
-        if random.random() < i / float(length):
-            yield convert_note(note, mapping, next_section)
+        if rng.random() < i / float(length):
+            yield translate_note(note, next_table)
         else:
-            yield convert_note(note, mapping, section)
+            yield translate_note(note, table)
 
 
 def convert_note(note_value, mapping, section):
@@ -122,18 +249,139 @@ def convert_note(note_value, mapping, section):
     return mapping[section][index]
 
 
-def update_chord(note_value, prob, note_set, chord_increase):
+def create_translation_tables(mapping):
+
+    '''Precomputes the conversions done by convert_note. Takes a
+    mapping dictionary (section to notes) and returns a dictionary
+    where keys are sections and values are dictionaries from each
+    note of section A to its value within that section. Section A
+    itself has no table (None), as its notes are left unchanged.'''
+
+    tables = {}
+    reference = mapping.get('A', [])
+    for section, notes in mapping.items():
+        if section == 'A':
+            tables[section] = None
+            continue
+        table = {}
+        for note_value, new_value in zip(reference, notes):
+            table.setdefault(note_value, new_value)  # first match, like list.index
+        tables[section] = table
+    return tables
+
+
+def get_translation_table(mapping, section, tables=None):
+
+    '''Component of generate_section and generate_transition.
+    Returns the translation table of a section, taken from tables
+    when available or built from the mapping otherwise. Raises
+    KeyError for sections missing from the mapping.'''
+
+    if tables is not None:
+        return tables[section]
+    if section == 'A':
+        return None
+    return create_translation_tables({'A': mapping['A'],
+                                      section: mapping[section]})[section]
+
+
+def translate_note(note_value, table):
+
+    '''Component of generate_section and generate_transition. Same as
+    convert_note, with a translation table (None for section A) in
+    place of the mapping and section.'''
+
+    if table is None:
+        return note_value
+    try:
+        return table[note_value]
+    except KeyError:
+        raise ValueError('{} is not a note of section A'.format(note_value))
+
+
+CompiledNoteSet = collections.namedtuple('CompiledNoteSet',
+                                         'candidates first_notes')
+
+
+def compile_note_set(note_set):
+
+    '''Component of the chorded sequence. Precomputes a note set for
+    update_chord, with chords as pitch masks (bit n set for note n).
+    Each note value of the set becomes a (bit of its first note, mask
+    of all its notes) candidate, and first_notes is the mask of all the
+    first notes. Output is a CompiledNoteSet.'''
+
+    candidates = tuple((1 << note_value[0], note_mask(note_value))
+                       for note_value in note_set)
+    first_notes = 0
+    for first_note, _ in candidates:
+        first_notes |= first_note
+    return CompiledNoteSet(candidates, first_notes)
+
+
+def note_mask(note_value):
+
+    '''Converts a note value (tuple of notes) to a pitch mask.'''
+
+    mask = 0
+    for note in note_value:
+        mask |= 1 << note
+    return mask
+
+
+def mask_to_notes(mask):
+
+    '''Converts a pitch mask to a tuple of notes, lowest first.'''
+
+    notes = []
+    while mask:
+        lowest = mask & -mask
+        notes.append(lowest.bit_length() - 1)
+        mask ^= lowest
+    return tuple(notes)
+
+
+def update_chord(note_value, prob, note_set, chord_increase, rng=random):
     
     '''Component of the chorded sequence. Updates a note or existing chord
-    by adding other notes from the current section's note set. Does so
-    depending on the input probability and potentially as many times as
-    the input chord increase. Returns the updated chord.'''
+    by adding other notes from the current section's note set (a list of
+    note values, or a CompiledNoteSet). Does so depending on the input
+    probability and potentially as many times as the input chord increase.
+    Note values whose first note is already in the chord are never added.
+    Returns the updated chord: the input note value followed by the added
+    notes, lowest first.'''
     
+    if not isinstance(note_set, CompiledNoteSet):
+        note_set = compile_note_set(note_set)
+    candidates = note_set.candidates
+    chord = base = note_mask(note_value)
     for _ in range(chord_increase):
-        if random.random() < prob:
-            note_set = [note for note in note_set if note[0] not in note_value]
-            note_value += random.choice(note_set) if note_set else ()
-    return note_value
+        if rng.random() < prob and note_set.first_notes & ~chord:
+            for _ in range(8):  # rejection keeps the choice uniform over valid candidates
+                first_note, mask = rng.choice(candidates)
+                if not first_note & chord:
+                    break
+            else:
+                first_note, mask = rng.choice([candidate
+                                               for candidate in candidates
+                                               if not candidate[0] & chord])
+            chord |= mask
+    return note_value + mask_to_notes(chord & ~base)
+
+
+def update_chords(note_values, probs, note_set, chord_increase, rng=random):
+
+    '''Updates each note value with update_chord, using the matching
+    probability of probs and compiling the note set once. Chord updates
+    are profiled here, around the loop, rather than per call (see
+    profiled_map). Output is an iterator.'''
+
+    if not isinstance(note_set, CompiledNoteSet):
+        note_set = compile_note_set(note_set)
+    return profiled_map('chord_update', update_chord, note_values, probs,
+                        itertools.repeat(note_set),
+                        itertools.repeat(chord_increase),
+                        itertools.repeat(rng))
 
 
 def flatten_sequence(sequence):
@@ -1,98 +1,246 @@
+import os
 import random
+import itertools
+import collections
+from concurrent.futures import ProcessPoolExecutor
 
 import sequence_toolkit as tools
 from mapping_toolkit import Map
 
 
-def create_mapseq(melody, map_file):
+PARTS_PER_WORKER = 2  # parts of a seeded sequence generated ahead of the consumer
+
+
+def create_mapseq(melody, map_file, seed=None, workers=None):
     
     '''Takes a melody and a map file. Uses the information
     contained in the map file (sequence length, number of
     sections and transitions, sequence structure) to build
-    a composite (mapped) sequence.'''
+    a composite (mapped) sequence. If a seed is given, each
+    section and transition is generated independently from
+    its own random stream, on a pool of *workers* processes
+    (see generate_parts). Output is a list (see iter_mapseq).'''
     
-    sequence = []
+    return list(iter_mapseq(melody, map_file, seed, workers))
+
+
+def iter_mapseq(melody, map_file, seed=None, workers=None):
+
+    '''Builds a mapped sequence one note at a time, like create_mapseq,
+    so that the whole sequence is never held in memory (e.g. when
+    passed to write_midifile with fast=True). Output is a generator.'''
+
     seq_info = Map.from_map_file(map_file)
+    if seed is not None:
+        yield from iter_parts(melody, seq_info, seed, workers)
+        return
     notes = tools.generate_sequence(melody, seq_info.length) 
     section_lengths = iter(seq_info.sections)
     transition_lengths = iter(seq_info.transitions)
     for i, section in enumerate(seq_info.structure):
         # Adding Sections
-        sequence.extend(tools.generate_section(generator=notes,
-                                               length=next(section_lengths),
-                                               mapping=seq_info.mapping,
-                                               section=section))
-        try:
+        yield from tools.generate_section(generator=notes,
+                                          length=next(section_lengths),
+                                          mapping=seq_info.mapping,
+                                          section=section,
+                                          tables=seq_info.tables)
+        if i + 1 < len(seq_info.structure):
             # Adding Transitions
             next_section = seq_info.structure[i + 1]
-            sequence.extend(tools.generate_transition(generator=notes,
+            yield from tools.generate_transition(generator=notes,
                                          length=next(transition_lengths),
                                          mapping=seq_info.mapping,
                                          section=section,
-                                         next_section=next_section))
-        except IndexError:
-            pass
-    return sequence
+                                         next_section=next_section,
+                                         tables=seq_info.tables)
 
 
-def create_sparseseq(melody, length, fading=False):
+def create_sparseseq(melody, length, fading=False, rng=random):
     
     '''Creates a sequence with randomly occurring pauses (sparse sequence).
     With the default fading == False the pauses occur more frequently
     at the beginning, making the sequence emerge gradually from
     silence. If fading == True, pauses occur more often at the end,
-    making the sequence gradually fade into silence.'''
+    making the sequence gradually fade into silence. Takes an optional
+    random number generator (e.g. a seeded random.Random). Output is a
+    list (see iter_sparseseq).'''
     
-    sequence = []
-    notes = tools.generate_sequence(melody, length)
+    return list(iter_sparseseq(melody, length, fading, rng))
+
+
+def iter_sparseseq(melody, length, fading=False, rng=random):
+
+    '''Builds a sparse sequence one note at a time, like
+    create_sparseseq. Output is a generator.'''
+
+    notes = tools.generate_sequence(melody, length, rng)
     if fading:
         calculate_probability = lambda i: 1 - (i / float(length))
     else:
         calculate_probability = lambda i: i / float(length)
     for i in range(length):
         prob = calculate_probability(i)
-        if random.random() < prob:
-            sequence.append(next(notes))
+        if rng.random() < prob:
+            yield next(notes)
         else:
-            sequence.append((5,))
-    return sequence
+            yield (5,)
+
+
+def create_groupseq(melody, length, grouping='pauses', segment_size=None,
+                    rng=random):
 
+    '''Creates a sequence that keeps groups of notes of the melody
+    together (grouped sequence). The melody is split into groups by
+    pauses, pitch (repeated notes) or segments of segment_size notes,
+    according to grouping ('pauses', 'pitch' or 'segments'), and a new
+    sequence of *length* groups is built from them, then flattened.
+    Takes an optional random number generator.'''
+
+    if grouping == 'pauses':
+        groups = tools.group_by_pauses(melody)
+    elif grouping == 'pitch':
+        groups = tools.group_by_pitch(melody)
+    elif grouping == 'segments':
+        groups = tools.group_by_segment_size(melody, segment_size)
+    else:
+        raise ValueError('Unknown grouping {!r}. Must be pauses, pitch or '
+                         'segments.'.format(grouping))
+    return tools.flatten_sequence(tools.generate_sequence(groups, length, rng))
 
-def create_chordseq(melody, map_file, increase):
+
+def create_chordseq(melody, map_file, increase, seed=None, workers=None):
     
     '''Creates a variant of the mapped sequence with chords 
     occurring randomly throughout (chorded sequence). The chords 
     are of variable length, and are created by taking a base note 
     and adding other notes from the same section onto it. The chords 
     appear more frequently as the sequence progresses, similar to the 
-    pauses in a sparse sequence with fading == False.'''
+    pauses in a sparse sequence with fading == False. Seed and workers
+    work as in create_mapseq. Output is a list (see iter_chordseq).'''
     
-    sequence = []
+    return list(iter_chordseq(melody, map_file, increase, seed, workers))
+
+
+def iter_chordseq(melody, map_file, increase, seed=None, workers=None):
+
+    '''Builds a chorded sequence one note at a time, like
+    create_chordseq. Output is a generator.'''
+
     info = Map.from_map_file(map_file)
+    if seed is not None:
+        yield from iter_parts(melody, info, seed, workers, increase)
+        return
     notes = tools.generate_sequence(melody, info.length)
     section_lengths = iter(info.sections)
     transition_lengths = iter(info.transitions)
-    prob = 0.0
+    probs = itertools.accumulate(itertools.repeat(1 / float(info.length)),
+                                 initial=0.0)
     for i, letter in enumerate(info.structure):
-        note_set = info.mapping[letter]
+        note_set = tools.compile_note_set(info.mapping[letter])
         section = tools.generate_section(generator=notes,
                                   length=next(section_lengths),
                                   mapping=info.mapping,
-                                  section=letter)
-        for note in section:
-            sequence.append(tools.update_chord(note, prob, note_set, increase))
-            prob += 1 / float(info.length)
-        try:
+                                  section=letter,
+                                  tables=info.tables)
+        yield from tools.update_chords(section, probs, note_set, increase)
+        if i + 1 < len(info.structure):
             next_section = info.structure[i + 1]
-            note_set = info.mapping[letter] + info.mapping[info.structure[i + 1]]
+            note_set = tools.compile_note_set(info.mapping[letter] +
+                                              info.mapping[next_section])
             transition = tools.generate_transition(generator=notes,
                                          length=next(transition_lengths),
                                          mapping=info.mapping,
                                          section=letter,
-                                         next_section=next_section)
-            for note in transition:
-                sequence.append(tools.update_chord(note, prob, note_set, increase))
-                prob += 1 / float(info.length)
-        except IndexError:
-            pass
-    return sequence
+                                         next_section=next_section,
+                                         tables=info.tables)
+            yield from tools.update_chords(transition, probs, note_set,
+                                           increase)
+
+
+def split_map(info):
+
+    '''Lists the sections and transitions of a Map in structure order.
+    Output is a list of (section, next section, length, offset) tuples,
+    where next section is None for sections and offset is the position
+    of the first note within the whole sequence.'''
+
+    parts = []
+    offset = 0
+    for i, section in enumerate(info.structure):
+        parts.append((section, None, info.sections[i], offset))
+        offset += info.sections[i]
+        if i + 1 < len(info.structure):
+            parts.append((section, info.structure[i + 1], info.transitions[i],
+                          offset))
+            offset += info.transitions[i]
+    return parts
+
+
+def generate_part(melody, info, part, seed, increase=None):
+
+    '''Builds one section or transition of a mapped sequence (or of a
+    chorded sequence, if increase is given). Takes a melody, a Map, a part
+    from split_map and a seed. The part gets its own random stream,
+    derived from the seed and the part's offset. Output is a list.'''
+
+    section, next_section, length, offset = part
+    rng = random.Random('{}:{}'.format(seed, offset))
+    notes = tools.generate_sequence(melody, length, rng)
+    if next_section is None:
+        note_set = info.mapping[section]
+        part_notes = tools.generate_section(generator=notes,
+                                            length=length,
+                                            mapping=info.mapping,
+                                            section=section,
+                                            tables=info.tables)
+    else:
+        note_set = info.mapping[section] + info.mapping[next_section]
+        part_notes = tools.generate_transition(generator=notes,
+                                               length=length,
+                                               mapping=info.mapping,
+                                               section=section,
+                                               next_section=next_section,
+                                               tables=info.tables,
+                                               rng=rng)
+    if increase is None:
+        return list(part_notes)
+    probs = ((offset + i) / float(info.length) for i in itertools.count())
+    return list(tools.update_chords(part_notes, probs, note_set, increase,
+                                    rng))
+
+
+def generate_parts(melody, info, seed, workers=None, increase=None):
+
+    '''Builds a mapped (or chorded, if increase is given) sequence by
+    generating each of its sections and transitions with generate_part,
+    on a pool of *workers* processes (all cores by default, no pool if
+    workers == 1), then joining them in structure order. The output
+    only depends on the seed, not on the number of workers. Output is
+    a list (see iter_parts).'''
+
+    return list(iter_parts(melody, info, seed, workers, increase))
+
+
+def iter_parts(melody, info, seed, workers=None, increase=None):
+
+    '''Like generate_parts, but yields the notes of each part as soon as
+    it and the parts before it are done. At most PARTS_PER_WORKER parts
+    per worker are generated ahead of the consumer. Output is a
+    generator.'''
+
+    parts = split_map(info)
+    workers = workers or os.cpu_count() or 1
+    arguments = zip(itertools.repeat(melody), itertools.repeat(info), parts,
+                    itertools.repeat(seed), itertools.repeat(increase))
+    if workers == 1 or len(parts) < 2:
+        for part_arguments in arguments:
+            yield from generate_part(*part_arguments)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for part_arguments in arguments:
+            pending.append(executor.submit(generate_part, *part_arguments))
+            if len(pending) > PARTS_PER_WORKER * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
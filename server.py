@@ -0,0 +1,274 @@
+'''Long-running generation server. Accepts sequence jobs over HTTP (on
+localhost or a Unix socket) and answers with the bytes of the midi file,
+so that clients do not pay for starting Python for each sequence.
+
+Requests: POST /generate with a JSON job as body, with the keys of a
+batch.py job except output; instead of a source midi file, basic,
+mapped, sparse and chord jobs may give the model file of a
+TransitionModel (model_toolkit.py) as "model". File names are relative
+to the served root directory (the current directory by default), and
+files outside it are refused. GET /stats returns counters as JSON.
+
+Generation runs on a pool of processes, each keeping the melodies, Maps
+and models it has read in memory. Requests for the same source or model
+arriving within GROUP_WINDOW seconds of each other are grouped: they are
+sent to a worker together, which reads the source once and then
+generates their sequences one after another (each job keeps its own
+seed, so its output does not depend on the rest of its group).
+
+Usage: python server.py [--host HOST] [--port PORT] [--unix PATH]
+                        [--workers N] [--root DIRECTORY]'''
+
+import io
+import os
+import json
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from midi_toolkit import read_melody, write_midifile
+from model_toolkit import TransitionModel
+from batch import check_job, create_sequence
+
+
+GROUP_WINDOW = 0.005  # seconds a request waits for others on the same source
+MAX_GROUP = 64
+PATH_KEYS = ('source', 'map', 'model')  # job keys naming files within the root
+MAX_BODY = 1 << 20
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+def render_jobs(jobs):
+
+    '''Component of GenerationServer, run by the worker processes.
+    Builds the midi files of a group of jobs sharing the same source (or
+    model), which is read once. Output is a list of (midi bytes, error) tuples,
+    one for each job, where error is None for jobs that succeeded.'''
+
+    first = jobs[0]
+    try:
+        if first.get('model') is not None:
+            tracks = [TransitionModel.from_model_file(first['model'])]
+        else:
+            tracks = read_melody(first['source'], fast=True)
+    except Exception as error:
+        return [(None, describe_error(error))] * len(jobs)
+    results = []
+    for job in jobs:
+        try:
+            sequences = [create_sequence(job, melody) for melody in tracks]
+            midi_file = io.BytesIO()
+            write_midifile(midi_file, sequences, fast=True)
+            results.append((midi_file.getvalue(), None))
+        except Exception as error:
+            results.append((None, describe_error(error)))
+    return results
+
+
+def describe_error(error):
+    return '{}: {}'.format(type(error).__name__, error)
+
+
+def check_request(job, request_id, root):
+
+    '''Checks a job sent to /generate (see batch.check_job), which needs
+    a source or a model, and resolves its file names within the root
+    directory (see resolve_paths). Raises ValueError. Output is the
+    job.'''
+
+    job = check_job(job, request_id, required=())
+    if job.get('source') is None and job.get('model') is None:
+        raise ValueError('missing source or model')
+    if job['type'] == 'grouped' and job.get('source') is None:
+        raise ValueError('grouped sequences need a source midi file')
+    return resolve_paths(job, root)
+
+
+def resolve_paths(job, root):
+
+    '''Component of check_request. Turns the file names of a job (see
+    PATH_KEYS) into real paths, relative to root (an absolute real
+    path). Raises ValueError for files outside root, including through
+    symbolic links. Output is the job, with the resolved paths.'''
+
+    for key in PATH_KEYS:
+        name = job.get(key)
+        if name is None:
+            continue
+        if not isinstance(name, str):
+            raise ValueError('{} must be a file name'.format(key))
+        path = os.path.realpath(os.path.join(root, name))
+        if os.path.commonpath([root, path]) != root:
+            raise ValueError('{} is outside the served directory'.format(key))
+        job[key] = path
+    return job
+
+
+class GenerationServer(object):
+
+    '''Serves /generate and /stats requests for the files within a root
+    directory, collecting the jobs that share a source into groups for
+    the process pool.'''
+
+    def __init__(self, workers=None, root='.'):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.root = os.path.realpath(root)
+        self.groups = {}  # source key -> list of (job, future) waiting
+        self.stats = {'requests': 0, 'generated': 0, 'errors': 0,
+                      'groups': 0, 'grouped_jobs': 0}
+
+    def submit(self, job):
+
+        '''Queues a job. Output is a future of its (midi bytes, error)
+        tuple.'''
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if job.get('model') is not None:
+            key = ('model', job['model'])
+        else:
+            key = ('source', job['source'])
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = []
+            loop.call_later(GROUP_WINDOW, self.flush, key)
+        group.append((job, future))
+        if len(group) >= MAX_GROUP:
+            self.flush(key)
+        return future
+
+    def flush(self, key):
+        group = self.groups.pop(key, None)
+        if group:
+            asyncio.ensure_future(self.run_group(group))
+
+    async def run_group(self, group):
+        self.stats['groups'] += 1
+        self.stats['grouped_jobs'] += len(group)
+        loop = asyncio.get_running_loop()
+        jobs = [job for job, _ in group]
+        try:
+            results = await loop.run_in_executor(self.executor, render_jobs,
+                                                 jobs)
+        except Exception as error:  # e.g. a worker process died
+            results = [(None, describe_error(error))] * len(group)
+        for (_, future), result in zip(group, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def route(self, method, path, body):
+
+        '''Answers a request. Output is a tuple (status, content type,
+        content).'''
+
+        if path == '/stats':
+            if method != 'GET':
+                return 405, 'text/plain', b'Use GET.'
+            stats = dict(self.stats, pending=sum(map(len,
+                                                     self.groups.values())))
+            return 200, 'application/json', json.dumps(stats).encode()
+        if path != '/generate':
+            return 404, 'text/plain', b'Not found.'
+        if method != 'POST':
+            return 405, 'text/plain', b'Use POST.'
+        self.stats['requests'] += 1
+        try:
+            job = check_request(json.loads(body), self.stats['requests'],
+                                self.root)
+        except ValueError as error:  # includes invalid JSON
+            self.stats['errors'] += 1
+            return 400, 'text/plain', str(error).encode()
+        midi_bytes, error = await self.submit(job)
+        if error is not None:
+            self.stats['errors'] += 1
+            return 500, 'text/plain', error.encode()
+        self.stats['generated'] += 1
+        return 200, 'audio/midi', midi_bytes
+
+    async def handle(self, reader, writer):
+
+        '''Reads one HTTP request from a connection and answers it.'''
+
+        try:
+            try:
+                request_line = await reader.readline()
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, content_type, content = (413, 'text/plain',
+                                                     b'Body too large.')
+                else:
+                    body = await reader.readexactly(length)
+                    status, content_type, content = await self.route(
+                                                        method, path, body)
+            except (ValueError, asyncio.IncompleteReadError):
+                status, content_type, content = (400, 'text/plain',
+                                                 b'Malformed request.')
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\n'
+                         'Content-Length: {}\r\nConnection: close\r\n\r\n'
+                         .format(status, REASONS[status], content_type,
+                                 len(content)).encode('latin-1') + content)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+async def serve(host='127.0.0.1', port=8765, unix_path=None, workers=None,
+                root='.'):
+
+    '''Runs a GenerationServer for the files within root until
+    cancelled, on a Unix socket if unix_path is given, otherwise on host
+    and port.'''
+
+    server = GenerationServer(workers, root)
+    try:
+        if unix_path:
+            listener = await asyncio.start_unix_server(server.handle,
+                                                       path=unix_path)
+        else:
+            listener = await asyncio.start_server(server.handle, host, port)
+        async with listener:
+            print('Serving on {}.'.format(unix_path or
+                                          '{}:{}'.format(host, port)))
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on (default: localhost).')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port to listen on.')
+    parser.add_argument('--unix', metavar='PATH',
+                        help='Listen on a Unix socket instead.')
+    parser.add_argument('--workers', type=int,
+                        help='Number of processes (default: all cores).')
+    parser.add_argument('--root', default='.',
+                        help='Directory of the files jobs may read '
+                             '(default: the current directory).')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers,
+                          args.root))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
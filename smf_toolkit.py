@@ -0,0 +1,250 @@
+'''Contains functions to decode and encode Standard MIDI Files straight
+from and to their bytes, without building mido objects. Only the events
+needed by the sequences (note_on, note_off and delta times) are decoded.'''
+
+import mmap
+import struct
+import contextlib
+
+
+EVENT_LENGTHS = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1,
+                 0xE0: 2, 0xF1: 1, 0xF2: 2, 0xF3: 1}  # data bytes after the status byte
+
+TRACK_START = bytes.fromhex(
+    '00ff580404021808'  # time_signature 4/4
+    '00ff59020000'  # key_signature C
+    '00ff510307a120'  # set_tempo 500000
+    '00c000'  # program_change 0
+    '00b07900' '004000' '005b00' '000a3f' '000762')  # control_change 121, 64, 91, 10, 7
+TRACK_END = bytes.fromhex('00ff2f00')  # end_of_track
+FLUSH_SIZE = 1 << 16
+
+
+def read_smf_file(filename, tracks=None):
+
+    '''Maps a midi file into memory and decodes it. Returns a tuple
+    (ticks_per_beat, tracks), where tracks contains, for each track,
+    a list of (delta time, type, note, velocity, channel) events.
+    Events other than note_on and note_off have type None, and are
+    only kept when they carry a delta time. If tracks (a track number
+    or a collection of track numbers) is given, the other tracks are
+    skipped without being decoded, and left empty.'''
+
+    with map_smf_file(filename) as data:
+        return parse_smf(data, tracks)
+
+
+@contextlib.contextmanager
+def map_smf_file(filename):
+
+    '''Maps a midi file into memory. Output is a memoryview of its
+    bytes, released (and the file unmapped) on exit.'''
+
+    with open(filename, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files cannot be mapped
+            data = f.read()
+        try:
+            view = memoryview(data)
+            try:
+                yield view
+            finally:
+                view.release()
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def select_tracks(tracks):
+
+    '''Normalises a track selector: None (every track), a track number
+    or a collection of track numbers. Output is None or a frozenset.'''
+
+    if tracks is None:
+        return None
+    if isinstance(tracks, int):
+        return frozenset((tracks,))
+    return frozenset(tracks)
+
+
+def parse_smf(data, tracks=None):
+
+    '''Decodes the bytes of a midi file (bytes, mmap or memoryview).
+    Output is the same as read_smf_file.'''
+
+    ticks, chunks = read_smf_chunks(data)
+    tracks = select_tracks(tracks)
+    return ticks, [list(decode_track(data, start, end))
+                   if tracks is None or i in tracks else []
+                   for i, (start, end) in enumerate(chunks)]
+
+
+def read_smf_chunks(data):
+
+    '''Reads the header of a midi file. Returns a tuple (ticks_per_beat,
+    chunks) where chunks contains the (start, end) byte positions of
+    the data of each track chunk. Chunks of unknown type are skipped.
+    Raises the same errors as mido: OSError if the data is not a midi
+    file, EOFError if it ends before the header or a track chunk does.'''
+
+    if len(data) < 8:
+        raise EOFError('midi file ends within its header')
+    if bytes(data[:4]) != b'MThd':
+        raise OSError('MThd not found. Probably not a MIDI file')
+    size = struct.unpack_from('>L', data, 4)[0]
+    if size < 6 or 8 + size > len(data):
+        raise EOFError('midi file ends within its header')
+    _, num_tracks, ticks = struct.unpack_from('>HHH', data, 8)
+    position = 8 + size
+    chunks = []
+    while len(chunks) < num_tracks:
+        if position + 8 > len(data):
+            raise EOFError('midi file ends before track {}'.format(len(chunks)))
+        name, size = struct.unpack_from('>4sL', data, position)
+        position += 8
+        if name == b'MTrk':
+            if position + size > len(data):
+                raise EOFError('midi file ends within track {}'.format(
+                               len(chunks)))
+            chunks.append((position, position + size))
+        position += size
+    return ticks, chunks
+
+
+def read_variable_int(data, position):
+
+    '''Reads a variable length quantity starting at byte position.
+    Returns a tuple (value, position after the quantity).'''
+
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, position
+
+
+def decode_track(data, position, end):
+
+    '''Decodes the events of a track chunk, from byte position to end.
+    Handles running status the same way mido does (meta events do not
+    change it). Output is a generator of (delta time, type, note,
+    velocity, channel) events, as described in read_smf_file. Raises
+    EOFError, as mido does, if an event runs past the end of the chunk.'''
+
+    status = None
+    try:
+        while position < end:
+            delta = 0
+            while True:  # variable length quantity, inlined for speed
+                byte = data[position]
+                position += 1
+                delta = (delta << 7) | (byte & 0x7F)
+                if byte < 0x80:
+                    break
+            byte = data[position]
+            if byte < 0x80:
+                if status is None:
+                    raise OSError('running status without last_status')
+            else:
+                position += 1
+                if byte == 0xFF:  # meta event
+                    size, position = read_variable_int(data, position + 1)
+                    position += size
+                    if delta:
+                        yield delta, None, None, None, None
+                    continue
+                status = byte
+            if status in (0xF0, 0xF7):  # sysex event
+                size, position = read_variable_int(data, position)
+                position += size
+                if delta:
+                    yield delta, None, None, None, None
+                continue
+            kind = status & 0xF0 if status < 0xF0 else status
+            if kind == 0x90:
+                yield (delta, 'note_on', data[position], data[position + 1],
+                       status & 0x0F)
+            elif kind == 0x80:
+                yield (delta, 'note_off', data[position], data[position + 1],
+                       status & 0x0F)
+            elif delta:
+                yield delta, None, None, None, None
+            position += EVENT_LENGTHS.get(kind, 0)
+    except IndexError:  # the event runs past the end of the file
+        raise EOFError('midi track ends within an event')
+    if position > end:  # the last event runs into the next chunk
+        raise EOFError('midi track ends within an event')
+
+
+def encode_variable_int(value):
+
+    '''Encodes a non negative integer as a variable length quantity.
+    Returns a bytes object.'''
+
+    if value < 0:
+        raise ValueError('message time must be non-negative in MIDI file')
+    output = [value & 0x7F]
+    value >>= 7
+    while value:
+        output.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(output))
+
+
+def write_smf_file(target, tracks, ticks_per_beat=480):
+
+    '''Writes a midi file one event at a time. Takes a file name or a
+    seekable binary file object, and an iterable of tracks, each an
+    iterable of (chord, delta time) pairs. Tracks and pairs are consumed
+    lazily, so memory use does not depend on their length. The number of
+    tracks and the length of each track chunk are written once known.'''
+
+    if not hasattr(target, 'write'):
+        with open(target, 'wb') as outfile:
+            return write_smf_file(outfile, tracks, ticks_per_beat)
+    header_position = target.tell()
+    target.write(b'MThd' + struct.pack('>LHHH', 6, 1, 0, ticks_per_beat))
+    num_tracks = 0
+    for track in tracks:
+        write_smf_track(target, track)
+        num_tracks += 1
+    end_position = target.tell()
+    target.seek(header_position + 10)
+    target.write(struct.pack('>H', num_tracks))
+    target.seek(end_position)
+
+
+def write_smf_track(outfile, track):
+
+    '''Writes a track chunk with the same opening events as
+    midi_toolkit.write_midifile, followed by a note_on for each note of
+    each chord and the matching note_offs after its delta time. Data is
+    flushed to outfile in blocks and the chunk length is filled in at
+    the end.'''
+
+    chunk_position = outfile.tell()
+    outfile.write(b'MTrk\x00\x00\x00\x00')
+    size = 0
+    data = bytearray(TRACK_START)
+    for chord, delta_time in track:
+        data += b'\x00\x90'  # running status is used within chords
+        for note in chord:
+            data += bytes((note, 64, 0))  # each note_on is followed by a delta time of 0
+        data[-1:] = encode_variable_int(delta_time)  # except the last, followed by the chord's
+        data += bytes((0x80, chord[0], 0))
+        for note in chord[1:]:
+            data += bytes((0, note, 0))
+        if len(data) >= FLUSH_SIZE:
+            outfile.write(data)
+            size += len(data)
+            data.clear()
+    data += TRACK_END
+    outfile.write(data)
+    size += len(data)
+    end_position = outfile.tell()
+    outfile.seek(chunk_position + 4)
+    outfile.write(struct.pack('>L', size))
+    outfile.seek(end_position)